@@ -0,0 +1,242 @@
+"""
+A local stand-in for the Telegram Bot API, for load tests that run offline.
+
+Point telebot at it with
+
+    telebot.apihelper.API_URL = server.api_url
+
+Updates handed to deliver() are served to getUpdates long polls, or pushed
+to the webhook registered with setWebhook. Every outgoing call the bot makes
+(sendMessage, editMessageText, answerCallbackQuery, ...) is recorded with
+its arrival time so the load test can wait for and time the replies.
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Calls that put text into a chat; what a user would see as a reply.
+MESSAGE_METHODS = frozenset({
+    "sendMessage", "editMessageText", "sendDocument", "sendPhoto", "copyMessage",
+    "forwardMessage", "editMessageReplyMarkup", "editMessageCaption",
+})
+
+Call = namedtuple("Call", "at method chat_id text params")
+
+def _chat(chat_id):
+    """A Chat object for chat_id; '@channel' names get a stable negative id."""
+    try:
+        return {"id": int(chat_id), "type": "private", "first_name": "User"}
+    except (TypeError, ValueError):
+        name = str(chat_id).lstrip("@")
+        return {"id": -1000000000000 - sum(map(ord, name)), "type": "channel", "title": name, "username": name}
+
+class FakeBotApi:
+    """
+    Threaded HTTP server answering /bot<token>/<method> like the Bot API.
+
+    Members of every channel are reported as "member" and the bot itself as
+    "creator", so channel verification passes. A method listed in `fail`
+    answers with that error code, e.g. {"copyMessage": 403}.
+    """
+
+    def __init__(self, listen="127.0.0.1", port=0, fail=None, push_workers=8):
+        self.fail = dict(fail or {})
+        self.calls = []
+        self.counts = {}
+        self._by_chat = {}
+        self._cond = threading.Condition()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._push_queue = queue.Queue()
+        self._push_workers = push_workers
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.push_failures = 0
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        host, port = self.httpd.server_address[:2]
+        self.api_url = f"http://{host}:{port}/bot{{0}}/{{1}}"
+        self.file_url = f"http://{host}:{port}/file/bot{{0}}/{{1}}"
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out as separate writes; without this,
+            # Nagle plus delayed ACKs add ~40 ms to every kept-alive call.
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if body and content_type.startswith("application/json"):
+                    params.update(json.loads(body))
+                elif body and content_type.startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode()))
+                # multipart uploads (sendDocument) carry chat_id in the query string.
+                status, payload = server.handle(url.path.rsplit("/", 1)[-1], params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-bot-api", daemon=True).start()
+        for i in range(self._push_workers):
+            threading.Thread(target=self._push, name=f"fake-bot-api-push-{i}", daemon=True).start()
+        return self
+
+    def stop(self):
+        for _ in range(self._push_workers):
+            self._push_queue.put(None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # -- updates ---------------------------------------------------------
+
+    def deliver(self, update):
+        """Queue an update for getUpdates, or push it if a webhook is set; returns its id."""
+        update = dict(update, update_id=next(self._update_ids))
+        if self.webhook_url:
+            self._push_queue.put(update)
+        else:
+            with self._cond:
+                self._updates.append(update)
+                self._cond.notify_all()
+        return update["update_id"]
+
+    def _push(self):
+        while True:
+            update = self._push_queue.get()
+            if update is None:
+                return
+            headers = {"Content-Type": "application/json"}
+            if self.webhook_secret:
+                headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+            body = json.dumps(update).encode()
+            # Telegram retries pushes the webhook refused; so do we, briefly.
+            for delay in (0, 0.05, 0.2, 1):
+                time.sleep(delay)
+                try:
+                    request = urllib.request.Request(self.webhook_url, data=body, headers=headers)
+                    with urllib.request.urlopen(request, timeout=10) as response:
+                        if response.status == 200:
+                            break
+                except Exception:
+                    pass
+            else:
+                with self._cond:
+                    self.push_failures += 1
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._cond:
+            # Everything below offset has been confirmed.
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    # -- recorded calls --------------------------------------------------
+
+    def _record(self, method, params):
+        chat_id = params.get("chat_id")
+        text = params.get("text") or params.get("caption") or ""
+        call = Call(time.monotonic(), method, str(chat_id) if chat_id is not None else None, text, params)
+        with self._cond:
+            self.calls.append(call)
+            self.counts[method] = self.counts.get(method, 0) + 1
+            if call.chat_id is not None:
+                self._by_chat.setdefault(call.chat_id, []).append(call)
+            self._cond.notify_all()
+
+    def mark(self, chat_id):
+        """Position in chat_id's call history; pass it to wait_for() to see only newer calls."""
+        with self._cond:
+            return len(self._by_chat.get(str(chat_id), ()))
+
+    def wait_for(self, chat_id, since, predicate, timeout=10):
+        """
+        Wait for a call to chat_id after position `since` that satisfies
+        predicate(call). Returns the call, or None on timeout.
+        """
+        chat_id = str(chat_id)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                calls = self._by_chat.get(chat_id, ())
+                for call in calls[since:]:
+                    if predicate(call):
+                        return call
+                since = max(since, len(calls))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    # -- methods ---------------------------------------------------------
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": _chat(params.get("chat_id")),
+            "from": BOT_USER,
+            "text": params.get("text") or "",
+        }
+
+    def handle(self, method, params):
+        """Answer one Bot API call; returns (status, payload)."""
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        self._record(method, params)
+        if method in self.fail:
+            code = self.fail[method]
+            return code, {"ok": False, "error_code": code, "description": "Forbidden: bot was blocked by the user"}
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getChat":
+            result = _chat(params.get("chat_id"))
+        elif method == "getChatMember":
+            user_id = int(params.get("user_id"))
+            status = "creator" if user_id == BOT_USER["id"] else "member"
+            result = {"status": status, "is_anonymous": False,
+                      "user": {"id": user_id, "is_bot": user_id == BOT_USER["id"], "first_name": "User"}}
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url") or None
+            self.webhook_secret = params.get("secret_token") or None
+            result = True
+        elif method == "deleteWebhook":
+            self.webhook_url = self.webhook_secret = None
+            result = True
+        elif method == "copyMessage":
+            result = {"message_id": next(self._message_ids)}
+        elif method in MESSAGE_METHODS:
+            result = self._message(params)
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
@@ -0,0 +1,313 @@
+"""
+End-to-end load test against a fake Telegram Bot API.
+
+Runs the real bot (main.py) on a throwaway database, with telebot pointed at
+bench.fake_bot_api instead of api.telegram.org, so it needs no network and
+no token. --users scripted users, --concurrency of them at a time, each go
+through
+
+    /start [ref_<earlier user>] -> verify -> menu_rewards -> reward_<platform>
+    -> claim_<platform> -> /redeem <key or guess> -> get_ref_link
+
+sending an update, waiting for the reply it should produce and timing the
+round trip. Updates reach the bot by getUpdates long polling or, with
+--mode webhook, as pushes to webhook.WebhookServer.
+
+Reports updates/sec, p50/p95/p99 reply latency per step, callback handler
+time (from the router's timing hook), how long immediate transactions
+waited for the SQLite write lock, and the outbox and webhook counters.
+Exits 1 if a step timed out or a --max-*/--min-* threshold is missed, so CI
+can run it:
+
+    python -m bench.load_test [--users N] [--concurrency C] [--mode polling|webhook]
+                              [--max-p95-ms MS] [--min-updates-per-sec N] [--json PATH]
+
+Telegram's flood limits are lifted for the run unless --telegram-limits is
+given; with them the outbox, not the bot, sets the pace. The fake API and the
+scripted users share the bot's process, so compare numbers between runs on
+the same machine rather than against production.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from bench.fake_bot_api import FakeBotApi, BOT_USER
+
+FIRST_USER_ID = 9_000_000_000
+PLATFORMS = ["BenchFlix", "BenchMusic", "BenchVPN"]
+PLATFORM_PRICE = 2
+STEP_TIMEOUT = 30
+
+def percentile(samples, pct):
+    """The pct quantile of sorted samples (nearest rank), 0.0 if empty."""
+    return samples[min(len(samples) - 1, int(len(samples) * pct))] if samples else 0.0
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": samples[-1] * 1000 if samples else 0.0,
+    }
+
+def _expects(text=None, methods=("sendMessage", "editMessageText")):
+    """Predicate for the reply that completes a step."""
+    def predicate(call):
+        return call.method in methods and (text is None or text in call.text)
+    return predicate
+
+class Cohort:
+    """Scripted users driving the bot through the fake API and timing each reply."""
+
+    def __init__(self, api, users, keys, referral_rate, seed=1):
+        self.api = api
+        self.users = users
+        self.keys = keys
+        self.referral_rate = referral_rate
+        self.rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.timeouts = {}
+        self.updates = 0
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}", "username": f"bench{user_id}"}
+
+    def _message(self, user_id, text):
+        command = text.split()[0]
+        return {"message": {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Bench{user_id}"},
+            "from": self._user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }}
+
+    def _callback(self, user_id, data):
+        return {"callback_query": {
+            "id": str(next(self._ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"Bench{user_id}"},
+                "from": BOT_USER,
+                "text": "Main Menu",
+            },
+        }}
+
+    def _step(self, name, user_id, update, predicate):
+        since = self.api.mark(user_id)
+        sent_at = time.monotonic()
+        self.api.deliver(update)
+        reply = self.api.wait_for(user_id, since, predicate, timeout=STEP_TIMEOUT)
+        with self._lock:
+            self.updates += 1
+            if reply is None:
+                self.timeouts[name] = self.timeouts.get(name, 0) + 1
+            else:
+                self.latencies.setdefault(name, []).append(reply.at - sent_at)
+        return reply is not None
+
+    def run_user(self, index):
+        user_id = FIRST_USER_ID + index
+        start = "/start"
+        if index and self.rng.random() < self.referral_rate:
+            start += f" ref_{FIRST_USER_ID + self.rng.randrange(index)}"
+        platform = PLATFORMS[index % len(PLATFORMS)]
+        # Every other user has a real key; the rest guess.
+        key = self.keys[index // 2] if index % 2 == 0 else f"GUESS-{user_id}"
+        steps = [
+            ("start", self._message(user_id, start), _expects("Main Menu")),
+            ("verify", self._callback(user_id, "verify"), _expects("Main Menu")),
+            ("menu_rewards", self._callback(user_id, "menu_rewards"), _expects("Available Platforms")),
+            ("reward", self._callback(user_id, f"reward_{platform}"), _expects(platform)),
+            ("claim", self._callback(user_id, f"claim_{platform}"),
+             lambda call: call.method == "sendMessage" and any(
+                 text in call.text for text in ("PREMIUM ACCOUNT", "Insufficient points", "No accounts"))),
+            ("redeem", self._message(user_id, f"/redeem {key}"), _expects("Key", methods=("sendMessage",))),
+            ("referral", self._callback(user_id, "get_ref_link"), _expects("referral link", methods=("sendMessage",))),
+        ]
+        for name, update, predicate in steps:
+            if not self._step(name, user_id, update, predicate):
+                # The rest of this user's script depends on the missing reply.
+                return
+
+def seed(users):
+    """Platforms with enough stock for every user, and a key for every other user."""
+    import db
+    from handlers import admin
+    per_platform = users // len(PLATFORMS) + 1
+    for platform in PLATFORMS:
+        admin.add_platform(platform, PLATFORM_PRICE)
+        db.add_stock_items(platform, [f"{platform.lower()}{i}@bench.invalid:pw{i}" for i in range(per_platform)])
+    return db.add_keys([f"BENCH-{i:08d}" for i in range(users // 2 + 1)], "normal", 5)
+
+def start_ingress(bot, api, mode):
+    """Start feeding updates to the bot; returns a function that stops it and the webhook server, if any."""
+    if mode == "webhook":
+        from webhook import WebhookServer
+        server = WebhookServer(bot, "127.0.0.1", 0, config.WEBHOOK_PATH, secret=config.WEBHOOK_SECRET,
+                               workers=config.WEBHOOK_WORKERS, queue_size=config.WEBHOOK_QUEUE_SIZE)
+        server.start()
+        host, port = server.httpd.server_address[:2]
+        bot.remove_webhook()
+        bot.set_webhook(url=f"http://{host}:{port}{config.WEBHOOK_PATH}", secret_token=server.secret)
+        return server.stop, server
+    thread = threading.Thread(target=bot.polling, kwargs={"non_stop": True, "interval": 0, "timeout": 5,
+                                                           "long_polling_timeout": 1}, daemon=True)
+    thread.start()
+    def stop():
+        bot.stop_polling()
+        thread.join(5)
+    return stop, None
+
+def run(args, api):
+    import db
+    db.DATABASE = os.path.join(args.workdir, "bot.db")
+    import main
+    from handlers.outbox import outbox
+    from handlers.router import callbacks
+
+    keys = seed(args.users)
+    handler_times = {}
+    handler_lock = threading.Lock()
+    def on_callback(pattern, elapsed):
+        with handler_lock:
+            handler_times.setdefault(pattern, []).append(elapsed)
+    callbacks.add_timing_hook(on_callback)
+
+    stop_ingress, webhook_server = start_ingress(main.bot, api, args.mode)
+    cohort = Cohort(api, args.users, keys, args.referral_rate)
+    db.lock_wait_stats(reset=True)
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench-user") as pool:
+            list(pool.map(cohort.run_user, range(args.users)))
+        elapsed = time.monotonic() - started
+    finally:
+        stop_ingress()
+
+    steps = {name: summarize(samples) for name, samples in cohort.latencies.items()}
+    report = {
+        "mode": args.mode,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "telegram_limits": args.telegram_limits,
+        "elapsed_s": elapsed,
+        "updates": cohort.updates,
+        "updates_per_sec": cohort.updates / elapsed if elapsed else 0.0,
+        "timeouts": cohort.timeouts,
+        "latency": summarize(itertools.chain.from_iterable(cohort.latencies.values())),
+        "steps": steps,
+        "callback_handlers": {pattern: summarize(samples) for pattern, samples in handler_times.items()},
+        "db_lock_wait": db.lock_wait_stats(),
+        "outbox": outbox.metrics(),
+        "api_calls": dict(sorted(api.counts.items())),
+    }
+    if webhook_server is not None:
+        report["webhook"] = webhook_server.metrics()
+    return report
+
+def print_report(report):
+    print(f"{report['users']} users, concurrency {report['concurrency']}, {report['mode']} mode"
+          f"{', Telegram flood limits' if report['telegram_limits'] else ''}")
+    print(f"{report['updates']} updates in {report['elapsed_s']:.2f}s: {report['updates_per_sec']:.1f} updates/sec")
+    row = "{:<24} {:>7} {:>9} {:>9} {:>9} {:>9}"
+    print()
+    print(row.format("reply latency", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for name, s in list(report["steps"].items()) + [("all", report["latency"])]:
+        print(row.format(name, s["count"], f"{s['p50_ms']:.1f}", f"{s['p95_ms']:.1f}", f"{s['p99_ms']:.1f}", f"{s['max_ms']:.1f}"))
+    print()
+    print(row.format("callback handler", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for name, s in sorted(report["callback_handlers"].items()):
+        print(row.format(name, s["count"], f"{s['p50_ms']:.1f}", f"{s['p95_ms']:.1f}", f"{s['p99_ms']:.1f}", f"{s['max_ms']:.1f}"))
+    lock = report["db_lock_wait"]
+    print()
+    print(f"DB lock wait: {lock['transactions']} immediate transactions, "
+          f"avg {lock['avg_ms']:.2f} ms, max {lock['max_ms']:.1f} ms, total {lock['total_ms']:.0f} ms")
+    outbox = report["outbox"]
+    print(f"Outbox: {outbox['sent']} sent, {outbox['throttled']} throttled, {outbox['failed']} failed, "
+          f"avg wait {outbox['avg_wait_ms']:.1f} ms")
+    if "webhook" in report:
+        hook = report["webhook"]
+        print(f"Webhook: {hook['processed']} processed, {hook['rejected']} rejected, {hook['failed']} failed, "
+              f"p95 {hook['latency_p95_ms']:.1f} ms")
+    print("API calls: " + ", ".join(f"{method} {count}" for method, count in report["api_calls"].items()))
+    if report["timeouts"]:
+        print("Timed out: " + ", ".join(f"{name} {count}" for name, count in report["timeouts"].items()))
+
+def check_thresholds(report, args):
+    """Messages for every missed threshold."""
+    problems = []
+    if report["timeouts"]:
+        problems.append(f"{sum(report['timeouts'].values())} step(s) got no reply within {STEP_TIMEOUT}s")
+    if args.max_p95_ms is not None and report["latency"]["p95_ms"] > args.max_p95_ms:
+        problems.append(f"p95 reply latency {report['latency']['p95_ms']:.1f} ms > {args.max_p95_ms} ms")
+    if args.min_updates_per_sec is not None and report["updates_per_sec"] < args.min_updates_per_sec:
+        problems.append(f"{report['updates_per_sec']:.1f} updates/sec < {args.min_updates_per_sec}")
+    if args.max_lock_wait_ms is not None and report["db_lock_wait"]["max_ms"] > args.max_lock_wait_ms:
+        problems.append(f"DB lock wait {report['db_lock_wait']['max_ms']:.1f} ms > {args.max_lock_wait_ms} ms")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50, help="users active at once")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--referral-rate", type=float, default=0.3, help="share of users who start with a referral link")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the outbox's flood limits")
+    parser.add_argument("--max-p95-ms", type=float)
+    parser.add_argument("--min-updates-per-sec", type=float)
+    parser.add_argument("--max-lock-wait-ms", type=float)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    api = FakeBotApi().start()
+    # Everything that reads these at import time is imported below.
+    config.BOT_API_URL = api.api_url
+    config.BOT_FILE_URL = api.file_url
+    config.USE_WEBHOOK = args.mode == "webhook"
+    if not args.telegram_limits:
+        config.OUTBOX_GLOBAL_RATE = config.OUTBOX_CHAT_RATE = config.OUTBOX_CHAT_BURST = 1_000_000
+    args.workdir = tempfile.mkdtemp(prefix="load-test-")
+    try:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+            report = run(args, api)
+    finally:
+        from handlers.logs import shipper
+        import db
+        shipper.close()
+        api.stop()
+        db.close_connection()
+        shutil.rmtree(args.workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    problems = check_thresholds(report, args)
+    for problem in problems:
+        print(f"FAIL   {problem}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""
+Query plan check for the SQL in db.py and handlers/.
+
+Seeds a throwaway database with --users users (default 1,000,000) and
+proportional referrals, keys, stock, logs and reviews, then collects every
+statement two ways:
+
+  * statically, every string literal passed to execute()/executemany() in
+    db.py and handlers/*.py;
+  * dynamically, the expanded SQL SQLite reports while the bot-independent
+    db and admin functions run once, which also covers statements built with
+    f-strings and the ones triggers run.
+
+Each distinct statement gets an EXPLAIN QUERY PLAN. A plain full-table SCAN
+of one of the large tables fails the check unless the statement is listed in
+ALLOWED_SCANS with a reason. Exits 1 on failure.
+
+    python check_query_plans.py [--users N] [--verbose]
+"""
+import argparse
+import ast
+import glob
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import db
+from handlers.logs import shipper
+
+# Tables that grow with the user base; a full scan of these is a regression.
+LARGE_TABLES = {"users", "referrals", "keys", "stock_items", "admin_logs", "reviews", "points_histogram"}
+
+# Normalized statement prefix -> why a full scan is acceptable there.
+ALLOWED_SCANS = {
+    "select * from keys": "get_keys() exports every key; not used by any handler",
+    "select count(*) from users where banned = ? and blocked = ?": "create_broadcast() counts recipients once per broadcast",
+    "update user_stats set total_users = (select count(*) from users)": "user stats migration seeds the counters once",
+    "delete from stock_items as s where s.claimed_by is null and exists": "remove_duplicate_stock() checks every unclaimed item by design",
+}
+
+SOURCES = ["db.py"] + sorted(glob.glob("handlers/*.py"))
+
+def normalize(sql):
+    """Lower-case, collapse whitespace and replace literals and parameters with '?'."""
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    sql = re.sub(r"\?\d+", "?", sql)
+    sql = re.sub(r"[xX]?'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip().lower()
+    sql = re.sub(r"\?(?:\s*,\s*\?)+", "?", sql)
+    return sql.rstrip(";").strip()
+
+def static_statements():
+    """String-literal SQL passed to .execute()/.executemany() in the sources."""
+    found = {}
+    for path in SOURCES:
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in ("execute", "executemany") and node.args
+                    and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)):
+                sql = node.args[0].value
+                found.setdefault(normalize(sql), (sql, f"{path}:{node.lineno}"))
+    return found
+
+def seed(conn, users):
+    """Fill the base tables; the remaining migrations then build their derived data."""
+    rng = random.Random(42)
+    first_id = 1_000_000_000
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO users (telegram_id, username, join_date, points, referrals, banned) VALUES (?, ?, ?, ?, ?, ?)",
+        ((str(first_id + i), f"user{i}", f"2025-{1 + i % 12:02d}-{1 + i % 28:02d}",
+          rng.randint(0, 5000), rng.randint(0, 50), 1 if i % 97 == 0 else 0) for i in range(users)))
+    db._add_column(conn, "referrals", "referred_at", "TEXT")
+    now = time.time()
+    conn.executemany("INSERT OR IGNORE INTO referrals (user_id, referred_id, referred_at) VALUES (?, ?, ?)",
+                     ((str(first_id + rng.randrange(i or 1)), str(first_id + i),
+                       time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - rng.randrange(30 * 86400))))
+                      for i in range(0, users, 5)))
+    conn.executemany("INSERT INTO keys (\"key\", type, points, claimed, claimed_by) VALUES (?, ?, ?, ?, ?)",
+                     ((f"SEED-{i:08d}", "normal", 10, i % 2, str(first_id + i) if i % 2 else None) for i in range(users // 5)))
+    platforms = [f"Platform{p}" for p in range(20)]
+    conn.executemany("INSERT INTO platforms (platform_name, stock, price) VALUES (?, '[]', 5)", ((p,) for p in platforms))
+    conn.executemany("INSERT INTO stock_items (platform_name, content, claimed_by) VALUES (?, ?, ?)",
+                     ((platforms[i % 20], f"user{i}:pass{i}", str(first_id + i) if i % 3 == 0 else None) for i in range(users // 10)))
+    conn.executemany("INSERT INTO admin_logs (admin_id, action) VALUES (?, ?)",
+                     ((str(first_id + i % 50), f"action {i}") for i in range(users // 10)))
+    conn.executemany("INSERT INTO reviews (user_id, review) VALUES (?, ?)",
+                     ((str(first_id + i), f"review {i}") for i in range(users // 20)))
+    conn.execute("COMMIT")
+    return first_id
+
+def exercise(first_id):
+    """Call the db and admin functions that need no bot once each."""
+    from handlers import admin
+    uid, new_id = str(first_id + 123), "999999999999"
+    db.get_user(uid)
+    db.add_user(new_id, "checker", "2026-01-01", pending_referrer=uid)
+    for sort in db.USER_SORTS:
+        rows, _ = db.get_users_page(sort)
+        db.get_users_page(sort, (rows[-1]["sort_key"], rows[-1]["telegram_id"]))
+        db.get_users_page(sort, (rows[0]["sort_key"], rows[0]["telegram_id"]), backwards=True)
+    db.search_users(str(first_id + 12))
+    db.search_users("user12")
+    db.update_user_points(uid, 77)
+    db.add_user_points(uid, 5)
+    db.ban_user(uid)
+    db.unban_user(uid)
+    db.set_users_blocked([uid])
+    db.set_users_blocked([uid], blocked=False)
+    db.update_user_verified(uid)
+    db.add_referral(uid, new_id)
+    db.clear_pending_referral(new_id)
+    db.get_downline(uid)
+    db.get_downline(uid, limit=21, offset=20)
+    db.get_direct_referrals(uid)
+    db.get_downline_stats(uid)
+    db.get_upline(new_id)
+    db.get_referral_bursts(threshold=2)
+    db.referral_burst_size(uid)
+    db.add_review(uid, "check")
+    db.log_admin_action(uid, "check")
+    db.get_admins()
+    db.add_keys(["CHECK-1", "CHECK-2"], "normal", 5)
+    db.add_key("CHECK-3", "premium", 5)
+    db.get_key("CHECK-1")
+    db.claim_key_in_db("CHECK-1", uid)
+    db.get_leaderboard(10, by="points")
+    db.get_leaderboard(10, by="referrals")
+    db.get_leaderboard(50)
+    db.get_points_rank(100)
+    db.get_admin_dashboard()
+    db.get_dashboard_history()
+    broadcast = db.create_broadcast(uid, uid, 1, uid, 2)
+    batch = db.get_broadcast_recipients(None, 500)
+    db.get_broadcast_recipients(batch[-1], 500)
+    db.checkpoint_broadcast(broadcast["id"], batch[-1], len(batch), 0, 0)
+    db.get_running_broadcasts()
+    db.finish_broadcast(broadcast["id"])
+    admin.add_platform("CheckFlix", 5)
+    db.add_stock_items("CheckFlix", ["a:1", "a:2", "a:1"])
+    db.get_platforms()
+    db.get_platform("CheckFlix")
+    db.get_stock_count("CheckFlix")
+    db.claim_stock(uid, "CheckFlix")
+    db.update_stock_for_platform("CheckFlix", ["b:1"])
+    db.update_platform_price("CheckFlix", 6)
+    db.rename_platform("CheckFlix", "CheckFlix2")
+    db.backfill_stock_hashes()
+    db.remove_duplicate_stock()
+    admin.remove_platform("CheckFlix2")
+    db.set_account_claim_cost(db.get_account_claim_cost())
+    db.load_config()
+    admin.add_channel("https://t.me/check")
+    for channel in admin.get_channels():
+        admin.remove_channel(channel["id"])
+
+def full_scans(conn, sql):
+    """Plan details that scan a large table without an index."""
+    # Map aliases ("FROM stock_items AS s", "FROM stock_items o") back to table names.
+    aliases = {alias.lower(): table.lower() for table, alias in
+               re.findall(r"\b(?:from|join|update)\s+(\w+)\s+(?:as\s+)?(\w+)", sql, re.IGNORECASE)}
+    numbered = [int(n) for n in re.findall(r"\?(\d+)", sql)]
+    params = max(numbered) if numbered else sql.count("?")
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", (None,) * params).fetchall()
+    details = [row[3] for row in plan]
+    bad = []
+    for detail in details:
+        m = re.match(r"SCAN (\w+)(.*)", detail)
+        if m and "USING" not in m.group(2):
+            table = aliases.get(m.group(1).lower(), m.group(1).lower())
+            if table in LARGE_TABLES:
+                bad.append(detail)
+    return bad, details
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--verbose", action="store_true", help="print the plan of every statement")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shipper.close()  # no log channel traffic from a check run
+    workdir = tempfile.mkdtemp(prefix="query-plans-")
+    db.DATABASE = os.path.join(workdir, "bot.db")
+    try:
+        return run_checks(db.get_connection(), args)
+    finally:
+        db.close_connection()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_checks(conn, args):
+    started = time.perf_counter()
+    db.MIGRATIONS[0][1](conn)
+    first_id = seed(conn, args.users)
+    db.init_db()
+    conn.execute("ANALYZE")
+    print(f"Seeded {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    traced = {}
+    def trace(sql):
+        if not sql.lstrip().startswith("--"):
+            traced.setdefault(normalize(sql), sql)
+    conn.set_trace_callback(trace)
+    exercise(first_id)
+    conn.set_trace_callback(None)
+
+    statements = {}
+    for key, (sql, where) in static_statements().items():
+        statements[key] = (sql, where)
+    for key, sql in traced.items():
+        statements.setdefault(key, (sql, "traced"))
+
+    failures = 0
+    checked = 0
+    for key, (sql, where) in sorted(statements.items(), key=lambda item: item[1][1]):
+        if not re.match(r"\s*(select|update|delete|insert|replace|with)\b", sql, re.IGNORECASE):
+            continue
+        try:
+            bad, details = full_scans(conn, sql)
+        except Exception as e:
+            # f-string templates with {placeholders} cannot be planned; the traced run covers them.
+            if "{" in sql:
+                continue
+            print(f"ERROR  {where}: {e}\n       {key}")
+            failures += 1
+            continue
+        checked += 1
+        allowed = next((reason for prefix, reason in ALLOWED_SCANS.items() if key.startswith(prefix)), None)
+        if bad and not allowed:
+            failures += 1
+            print(f"FAIL   {where}: {key}\n       {'; '.join(details)}")
+        elif args.verbose:
+            status = "ALLOWED" if bad else "ok"
+            print(f"{status:<6} {where}: {key}\n       {'; '.join(details) or '(no table access)'}")
+    print(f"{checked} statements checked, {failures} full scan(s) of large tables")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
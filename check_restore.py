@@ -0,0 +1,135 @@
+"""
+Restore check for backups taken before the schema was versioned.
+
+Builds a database with the original schema (stock as a JSON array in
+platforms.stock, no stock_items, user_version 0), the kind of file the old
+/get command sent, and restores it over a current database with
+db.restore_database(). The restore must be accepted, migrate the file to
+SCHEMA_VERSION and leave the stock claimable. Exits 1 on failure.
+
+    python check_restore.py
+"""
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import db
+from handlers.logs import shipper
+
+# The tables of the original init_db(), before any migration.
+BASELINE_SCHEMA = f"""
+    CREATE TABLE users (
+        telegram_id TEXT PRIMARY KEY,
+        username TEXT,
+        join_date TEXT,
+        points INTEGER DEFAULT 20,
+        referrals INTEGER DEFAULT 0,
+        banned INTEGER DEFAULT 0,
+        pending_referrer TEXT,
+        verified INTEGER DEFAULT 0
+    );
+    CREATE TABLE referrals (
+        user_id TEXT,
+        referred_id TEXT,
+        PRIMARY KEY (user_id, referred_id)
+    );
+    CREATE TABLE platforms (
+        platform_name TEXT PRIMARY KEY,
+        stock TEXT,
+        price INTEGER DEFAULT 2,
+        platform_type TEXT DEFAULT 'account'
+    );
+    CREATE TABLE reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        review TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE admin_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id TEXT,
+        action TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE channels (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_link TEXT
+    );
+    CREATE TABLE admins (
+        user_id TEXT PRIMARY KEY,
+        username TEXT,
+        role TEXT,
+        banned INTEGER DEFAULT 0
+    );
+    CREATE TABLE keys (
+        "key" TEXT PRIMARY KEY,
+        type TEXT,
+        points INTEGER,
+        claimed INTEGER DEFAULT 0,
+        claimed_by TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE configurations (
+        config_key TEXT PRIMARY KEY,
+        config_value TEXT
+    );
+"""
+
+USER_ID = "1000001"
+PLATFORM = "OldFlix"
+STOCK = ["old1@example.com:pw1", "old2@example.com:pw2"]
+
+def make_baseline_backup(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (telegram_id, username, join_date, points) VALUES (?, 'olduser', NULL, 20)", (USER_ID,))
+    conn.execute("INSERT INTO platforms (platform_name, stock, price) VALUES (?, ?, 5)", (PLATFORM, json.dumps(STOCK)))
+    conn.execute("INSERT INTO keys (\"key\", type, points) VALUES ('OLD-KEY', 'normal', 10)")
+    conn.commit()
+    conn.close()
+
+def run_checks(workdir):
+    backup = os.path.join(workdir, "baseline.db")
+    make_baseline_backup(backup)
+
+    db.DATABASE = os.path.join(workdir, "bot.db")
+    db.init_db()
+    error = db.restore_database(backup)
+    if error:
+        return [f"restore rejected the baseline backup: {error}"]
+
+    failures = []
+    conn = db.get_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version != db.SCHEMA_VERSION:
+        failures.append(f"restored database is at version {version}, expected {db.SCHEMA_VERSION}")
+    if db.get_stock_count(PLATFORM) != len(STOCK):
+        failures.append(f"{PLATFORM} has {db.get_stock_count(PLATFORM)} items in stock, expected {len(STOCK)}")
+    result = db.claim_stock(USER_ID, PLATFORM)
+    if result.status != db.CLAIM_OK or result.item not in STOCK:
+        failures.append(f"claim after restore: {result}")
+    elif db.get_user(USER_ID)["points"] != 15:
+        failures.append(f"balance after claim is {db.get_user(USER_ID)['points']}, expected 15")
+    if not db.claim_key_in_db("OLD-KEY", USER_ID).startswith("Key redeemed"):
+        failures.append("the restored key could not be redeemed")
+    return failures
+
+def main():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shipper.close()  # no log channel traffic from a check run
+    workdir = tempfile.mkdtemp(prefix="restore-check-")
+    try:
+        failures = run_checks(workdir)
+    finally:
+        db.close_connection()
+        shutil.rmtree(workdir, ignore_errors=True)
+    for failure in failures:
+        print(f"FAIL   {failure}")
+    print(f"Baseline backup restore: {'failed' if failures else 'ok'}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
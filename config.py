@@ -18,3 +18,77 @@ LOGS_CHANNEL = "@ShadowBotLogs"
 
 DEFAULT_ACCOUNT_CLAIM_COST = 2 
 DEFAULT_REFERRAL_BONUS = 10    
+
+# Logs channel shipping: events are batched and sent every LOG_FLUSH_INTERVAL seconds.
+LOG_FLUSH_INTERVAL = 3
+LOG_QUEUE_SIZE = 5000
+
+# Channel membership cache (seconds). Failed checks expire sooner so users who
+# just joined can verify again quickly.
+MEMBERSHIP_CACHE_TTL = 300
+MEMBERSHIP_NEGATIVE_TTL = 20
+# Most (user, channel) answers kept; the least recently used go first.
+MEMBERSHIP_CACHE_SIZE = 100000
+MEMBERSHIP_CHECK_WORKERS = 8
+
+# Update ingress. Long polling is the default; with USE_WEBHOOK the bot runs an
+# HTTP server that Telegram pushes updates to at WEBHOOK_URL + WEBHOOK_PATH.
+USE_WEBHOOK = False
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/webhook"
+# Telegram sends this back with every push and other requests are refused.
+# Left empty, a random secret is generated at each start.
+WEBHOOK_SECRET = ""
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 10000
+
+# Bot API endpoint override, e.g. "http://127.0.0.1:8081/bot{0}/{1}" for a
+# local or fake Bot API server. None uses api.telegram.org. BOT_FILE_URL is the
+# matching file download endpoint, e.g. "http://127.0.0.1:8081/file/bot{0}/{1}".
+BOT_API_URL = None
+BOT_FILE_URL = None
+
+# /gen limits: batches larger than GEN_INLINE_LIMIT keys are sent as a .txt file.
+MAX_GEN_KEYS = 50000
+GEN_INLINE_LIMIT = 50
+
+# Account stock uploads are inserted STOCK_INGEST_BATCH lines per transaction.
+STOCK_INGEST_BATCH = 5000
+STOCK_MAX_LINE_LENGTH = 1024
+
+# Duplicate stock detection: "platform" rejects an item already stored for the
+# same platform, "global" rejects it if any platform has it.
+STOCK_DEDUP_SCOPE = "platform"
+
+# Outbound pacing (handlers/outbox.py): Telegram allows about 30 messages/s in
+# total and 1/s per chat; OUTBOX_CHAT_BURST lets a chat get a few quick replies.
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+OUTBOX_MAX_RETRIES = 3
+
+# Broadcasts: recipients are read and checkpointed BROADCAST_BATCH users at a
+# time and sent by BROADCAST_WORKERS threads at the lowest outbox priority.
+BROADCAST_BATCH = 500
+BROADCAST_WORKERS = 8
+BROADCAST_PROGRESS_INTERVAL = 5
+
+# Reviews and reports are sent to all OWNERS at once; failed sends are retried
+# after each of OWNER_RETRY_DELAYS seconds.
+OWNER_FANOUT_WORKERS = 4
+OWNER_RETRY_DELAYS = (5, 30, 120)
+
+# Local backups: a gzipped snapshot every BACKUP_INTERVAL_HOURS (0 disables),
+# keeping the newest BACKUP_KEEP files in BACKUP_DIR.
+BACKUP_DIR = "backups"
+BACKUP_INTERVAL_HOURS = 6
+BACKUP_KEEP = 10
+
+# Referral farm detection: a referrer who brings in REFERRAL_BURST_THRESHOLD or
+# more users within REFERRAL_BURST_WINDOW_MINUTES is flagged. The admin view
+# looks back REFERRAL_BURST_LOOKBACK_DAYS.
+REFERRAL_BURST_WINDOW_MINUTES = 10
+REFERRAL_BURST_THRESHOLD = 5
+REFERRAL_BURST_LOOKBACK_DAYS = 7
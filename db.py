@@ -1,21 +1,138 @@
 import sqlite3
 import os
-from datetime import datetime
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import json
 import config
-import telebot
 from handlers.logs import log_event
 
 DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot.db")
 
+# SQLite tuning applied to every pooled connection.
+BUSY_TIMEOUT_MS = 5000
+CACHED_STATEMENTS = 256
+
+_local = threading.local()
+
+# Write-lock waits in transaction(immediate=True): transactions, total and
+# longest wait in seconds.
+_lock_waits = [0, 0.0, 0.0]
+_lock_waits_lock = threading.Lock()
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DATABASE,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
 def get_connection():
-    return sqlite3.connect(DATABASE)
+    """
+    Return this thread's pooled connection, opening it on first use.
+    The connection runs in autocommit mode; group writes with transaction().
+    Callers must not close it.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "database", None) != DATABASE:
+        if conn is not None:
+            conn.close()
+        conn = _open_connection()
+        _local.conn = conn
+        _local.database = DATABASE
+    return conn
 
-def init_db():
+def close_connection():
+    """Close the calling thread's pooled connection, if any."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Run a block of statements as one transaction on the pooled connection:
+
+        with transaction() as conn:
+            conn.execute(...)
+
+    Commits on success and rolls back on error. immediate=True takes the
+    write lock up front (BEGIN IMMEDIATE) for read-check-write sequences.
+    Nested blocks join the outer transaction.
+    """
     conn = get_connection()
-    c = conn.cursor()
+    if conn.in_transaction:
+        yield conn
+        return
+    if immediate:
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        waited = time.perf_counter() - started
+        with _lock_waits_lock:
+            _lock_waits[0] += 1
+            _lock_waits[1] += waited
+            _lock_waits[2] = max(_lock_waits[2], waited)
+    else:
+        conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def lock_wait_stats(reset=False):
+    """
+    How long immediate transactions waited for the write lock: count, total
+    and mean/max in milliseconds. reset=True starts a new measurement.
+    """
+    with _lock_waits_lock:
+        count, total, longest = _lock_waits
+        if reset:
+            _lock_waits[:] = [0, 0.0, 0.0]
+    return {
+        "transactions": count,
+        "total_ms": total * 1000,
+        "avg_ms": total / count * 1000 if count else 0.0,
+        "max_ms": longest * 1000,
+    }
+
+def init_db():
+    """Bring the schema up to date (see migrate()) and load the config cache."""
+    migrate()
+    load_config()
+
+def _columns(conn, table):
+    return {col[1] for col in conn.execute(f"PRAGMA table_info({table})")}
+
+def _add_column(conn, table, column, declaration):
+    """ALTER TABLE ... ADD COLUMN unless it exists; returns True if it was added."""
+    if column in _columns(conn, table):
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return True
+
+# Migrations 1-10 predate user_version tracking, so they check what is already
+# there; databases from before the runner start at version 0 in any state.
+# Later migrations can rely on the steps before them having run.
+
+def _create_base_tables(conn):
     # Create users table
-    c.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS users (
         telegram_id TEXT PRIMARY KEY,
         username TEXT,
@@ -28,7 +145,7 @@ def init_db():
     )
     ''')
     # Create referrals table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS referrals (
             user_id TEXT,
             referred_id TEXT,
@@ -36,16 +153,17 @@ def init_db():
         )
     ''')
     # Create platforms table with the new column in the schema.
-    c.execute(f'''
+    conn.execute(f'''
         CREATE TABLE IF NOT EXISTS platforms (
             platform_name TEXT PRIMARY KEY,
             stock TEXT,
             price INTEGER DEFAULT {config.DEFAULT_ACCOUNT_CLAIM_COST},
-            platform_type TEXT DEFAULT 'account'
+            platform_type TEXT DEFAULT 'account',
+            stock_count INTEGER DEFAULT 0
         )
     ''')
     # Create other tables...
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS reviews (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT,
@@ -53,7 +171,7 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS admin_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             admin_id TEXT,
@@ -61,13 +179,13 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS channels (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             channel_link TEXT
         )
     ''')
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS admins (
             user_id TEXT PRIMARY KEY,
             username TEXT,
@@ -75,7 +193,7 @@ def init_db():
             banned INTEGER DEFAULT 0
         )
     ''')
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS keys (
             "key" TEXT PRIMARY KEY,
             type TEXT,
@@ -85,291 +203,1190 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS configurations (
             config_key TEXT PRIMARY KEY,
             config_value TEXT
         )
     ''')
-    conn.commit()
-    c.close()
-    conn.close()
-    migrate_db()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            platform_name TEXT NOT NULL REFERENCES platforms(platform_name)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            content TEXT NOT NULL,
+            content_hash BLOB,
+            added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            claimed_by TEXT,
+            claimed_at DATETIME
+        )
+    ''')
+    # Keyset pagination and prefix search in the admin user browser.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date, telegram_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_points ON users (points, telegram_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrals ON users (referrals, telegram_id)")
+    # Partial index over unclaimed rows only: the next claimable item of a
+    # platform is a single index seek no matter how much stock was handed out.
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stock_items_available
+        ON stock_items (platform_name, id) WHERE claimed_by IS NULL
+    ''')
+
+def _add_verified_column(conn):
+    _add_column(conn, "users", "verified", "INTEGER DEFAULT 0")
+
+def _add_platform_type(conn):
+    _add_column(conn, "platforms", "platform_type", "TEXT DEFAULT 'account'")
+
+def _add_stock_count(conn):
+    if _add_column(conn, "platforms", "stock_count", "INTEGER DEFAULT 0"):
+        conn.execute("""
+            UPDATE platforms SET stock_count = (
+                SELECT COUNT(*) FROM stock_items s
+                WHERE s.platform_name = platforms.platform_name AND s.claimed_by IS NULL)
+        """)
+    create_stock_count_triggers()
+
+def _add_stock_hashes(conn):
+    _add_column(conn, "stock_items", "content_hash", "BLOB")
+    # Serves both dedup scopes: content_hash alone (global) or with the platform.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_items_hash ON stock_items (content_hash, platform_name)")
+
+def _dedupe_stock(conn):
+    if backfill_stock_hashes():
+        remove_duplicate_stock()
+
+def _add_broadcasts(conn):
+    _add_column(conn, "users", "blocked", "INTEGER DEFAULT 0")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id TEXT,
+            from_chat_id TEXT,
+            message_id INTEGER,
+            progress_chat_id TEXT,
+            progress_message_id INTEGER,
+            cursor TEXT,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at TEXT,
+            finished_at TEXT
+        )
+    """)
+
+# Referral chains longer than this are not followed (guards against cycles).
+MAX_REFERRAL_DEPTH = 64
+
+def _add_query_indexes(conn):
+    # add_referral looks referrals up by the referred user; the primary key starts with user_id.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_keys_claimed_by ON keys (claimed_by)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_admin_logs_timestamp ON admin_logs (timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_admin_logs_admin ON admin_logs (admin_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reviews_timestamp ON reviews (timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reviews_user ON reviews (user_id, timestamp)")
+    # Renaming or removing a platform touches its claimed rows too, which the
+    # partial idx_stock_items_available does not cover.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_items_platform ON stock_items (platform_name)")
 
-def migrate_db():
+def _add_referral_paths(conn):
     """
-    Check if the 'platforms' table has the 'platform_type' column.
-    If not, add it via an ALTER TABLE command.
+    referral_paths is the closure of the referrals graph: one row per
+    (ancestor, descendant) pair with its distance, so a whole downline or
+    its depth profile is one index range read. It is backfilled here and
+    extended by a trigger on every new referral. referred_at stays NULL for
+    referrals made before it was recorded.
+    """
+    _add_column(conn, "referrals", "referred_at", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer_time ON referrals (user_id, referred_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referred_at ON referrals (referred_at, user_id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_paths (
+            ancestor TEXT NOT NULL,
+            descendant TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor, descendant)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_paths_descendant ON referral_paths (descendant, depth)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_paths_depth ON referral_paths (ancestor, depth)")
+    conn.execute(f"""
+        INSERT OR IGNORE INTO referral_paths (ancestor, descendant, depth)
+        WITH RECURSIVE paths (ancestor, descendant, depth) AS (
+            SELECT user_id, referred_id, 1 FROM referrals
+            UNION
+            SELECT p.ancestor, r.referred_id, p.depth + 1
+            FROM paths p JOIN referrals r ON r.user_id = p.descendant
+            WHERE p.depth < {MAX_REFERRAL_DEPTH}
+        )
+        SELECT ancestor, descendant, MIN(depth) FROM paths
+        WHERE ancestor != descendant
+        GROUP BY ancestor, descendant
+    """)
+    # Every ancestor of the referrer (and the referrer) gains the referred
+    # user and everything below them.
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_referrals_paths AFTER INSERT ON referrals BEGIN
+            INSERT OR IGNORE INTO referral_paths (ancestor, descendant, depth)
+            SELECT up.ancestor, down.descendant, up.depth + down.depth + 1
+            FROM (SELECT ancestor, depth FROM referral_paths WHERE descendant = NEW.user_id
+                  UNION ALL SELECT NEW.user_id, 0) AS up,
+                 (SELECT descendant, depth FROM referral_paths WHERE ancestor = NEW.referred_id
+                  UNION ALL SELECT NEW.referred_id, 0) AS down
+            WHERE up.ancestor != down.descendant;
+        END
+    """)
+
+def _add_unclaimed_keys_index(conn):
+    # Covers loading the set of redeemable keys without reading claimed ones.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_keys_unclaimed ON keys ("key") WHERE claimed = 0')
+
+def _add_join_sort_index(conn):
+    # Older rows can have a NULL join_date, which a row-value keyset
+    # comparison never matches; the user browser sorts on '' for those.
+    conn.execute("DROP INDEX IF EXISTS idx_users_join_date")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_join_key ON users (COALESCE(join_date, ''), telegram_id)")
+
+def _localtime_stats_days(conn):
+    # The first version of the trigger bucketed days by UTC date('now').
+    conn.execute("DROP TRIGGER IF EXISTS trg_user_stats_snapshot")
+    conn.execute(_USER_STATS_SNAPSHOT_TRIGGER)
+
+# Ordered schema migrations; the schema version (PRAGMA user_version) is the
+# number of entries applied. Append new steps, never reorder or edit old ones.
+MIGRATIONS = [
+    ("base tables", _create_base_tables),
+    ("users.verified", _add_verified_column),
+    ("platforms.platform_type", _add_platform_type),
+    ("platforms.stock_count", _add_stock_count),
+    ("stock_items.content_hash", _add_stock_hashes),
+    ("stock blobs to stock_items", lambda conn: migrate_stock_blobs()),
+    ("stock dedupe", _dedupe_stock),
+    ("points histogram", lambda conn: create_points_histogram()),
+    ("user stats", lambda conn: create_user_stats()),
+    ("broadcasts", _add_broadcasts),
+    ("query indexes", _add_query_indexes),
+    ("referral paths", _add_referral_paths),
+    ("unclaimed keys index", _add_unclaimed_keys_index),
+    ("users join sort index", _add_join_sort_index),
+    ("local-time stats days", _localtime_stats_days),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate():
+    """
+    Apply the migrations newer than the database's user_version, each in its
+    own BEGIN IMMEDIATE transaction together with the version bump and a row
+    in schema_migrations recording how long it took. On a current database
+    this is a single PRAGMA read. Returns the (version, name, ms) applied.
     """
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(platforms)")
-    columns = [col[1] for col in c.fetchall()]
-    if 'platform_type' not in columns:
-        c.execute("ALTER TABLE platforms ADD COLUMN platform_type TEXT DEFAULT 'account'")
-        conn.commit()
-    c.close()
-    conn.close()
-
-def add_verified_column():
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return []
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TEXT,
+            duration_ms REAL
+        )
+    """)
+    applied = []
+    for version, (name, step) in enumerate(MIGRATIONS, start=1):
+        with transaction(immediate=True):
+            # Re-read under the write lock in case another process got here first.
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            started = time.perf_counter()
+            step(conn)
+            duration_ms = (time.perf_counter() - started) * 1000
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("INSERT OR REPLACE INTO schema_migrations VALUES (?, ?, ?, ?)",
+                         (version, name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), duration_ms))
+        applied.append((version, name, duration_ms))
+        print(f"Applied migration {version} ({name}) in {duration_ms:.1f} ms")
+    return applied
+
+# Days are local dates, like join_date and every other time the bot stores.
+_USER_STATS_SNAPSHOT_TRIGGER = """
+    CREATE TRIGGER trg_user_stats_snapshot AFTER UPDATE ON user_stats BEGIN
+        INSERT INTO user_stats_daily (day, total_users, banned_users, total_points)
+        VALUES (date('now', 'localtime'), NEW.total_users, NEW.banned_users, NEW.total_points)
+        ON CONFLICT (day) DO UPDATE SET
+            total_users = excluded.total_users,
+            banned_users = excluded.banned_users,
+            total_points = excluded.total_points;
+    END
+"""
+
+def create_user_stats():
+    """
+    user_stats is a single row of dashboard counters (users, banned users,
+    points in circulation) kept current by triggers on users, so the admin
+    dashboard never scans the table. Every change also rewrites today's row
+    in user_stats_daily, which leaves one end-of-day snapshot per active day.
+    """
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(users)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'verified' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN verified INTEGER DEFAULT 0")
-        conn.commit()
-    c.close()
-    conn.close()
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'").fetchone()
+    if exists:
+        return
+    with transaction():
+        conn.execute("""
+            CREATE TABLE user_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_users INTEGER NOT NULL,
+                banned_users INTEGER NOT NULL,
+                total_points INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_stats_daily (
+                day TEXT PRIMARY KEY,
+                total_users INTEGER NOT NULL,
+                banned_users INTEGER NOT NULL,
+                total_points INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute(_USER_STATS_SNAPSHOT_TRIGGER)
+        conn.execute("INSERT INTO user_stats VALUES (1, 0, 0, 0)")
+        conn.execute("""
+            UPDATE user_stats SET
+                total_users = (SELECT COUNT(*) FROM users),
+                banned_users = (SELECT COUNT(*) FROM users WHERE banned = 1),
+                total_points = (SELECT COALESCE(SUM(points), 0) FROM users)
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_user_stats_insert AFTER INSERT ON users BEGIN
+                UPDATE user_stats SET
+                    total_users = total_users + 1,
+                    banned_users = banned_users + (NEW.banned = 1),
+                    total_points = total_points + COALESCE(NEW.points, 0);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_user_stats_delete AFTER DELETE ON users BEGIN
+                UPDATE user_stats SET
+                    total_users = total_users - 1,
+                    banned_users = banned_users - (OLD.banned = 1),
+                    total_points = total_points - COALESCE(OLD.points, 0);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_user_stats_update AFTER UPDATE OF banned, points ON users
+            WHEN OLD.banned IS NOT NEW.banned OR OLD.points IS NOT NEW.points BEGIN
+                UPDATE user_stats SET
+                    banned_users = banned_users + (NEW.banned = 1) - (OLD.banned = 1),
+                    total_points = total_points + COALESCE(NEW.points, 0) - COALESCE(OLD.points, 0);
+            END
+        """)
 
-def update_user_verified(telegram_id):
+def create_points_histogram():
+    """
+    points_histogram holds how many users have each point balance, kept
+    current by triggers on users. A user's rank is then a sum over the
+    (few) distinct balances above theirs rather than a count over users.
+    """
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET verified = 1 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    c.close()
-    conn.close()
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'points_histogram'").fetchone()
+    if exists:
+        return
+    with transaction():
+        conn.execute("CREATE TABLE points_histogram (points INTEGER PRIMARY KEY, n INTEGER NOT NULL) WITHOUT ROWID")
+        conn.execute("INSERT INTO points_histogram SELECT points, COUNT(*) FROM users WHERE points IS NOT NULL GROUP BY points")
+        conn.execute("""
+            CREATE TRIGGER trg_users_points_insert AFTER INSERT ON users
+            WHEN NEW.points IS NOT NULL BEGIN
+                INSERT INTO points_histogram (points, n) VALUES (NEW.points, 1)
+                ON CONFLICT (points) DO UPDATE SET n = n + 1;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_users_points_delete AFTER DELETE ON users
+            WHEN OLD.points IS NOT NULL BEGIN
+                UPDATE points_histogram SET n = n - 1 WHERE points = OLD.points;
+                DELETE FROM points_histogram WHERE points = OLD.points AND n <= 0;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_users_points_update AFTER UPDATE OF points ON users
+            WHEN OLD.points IS NOT NEW.points BEGIN
+                UPDATE points_histogram SET n = n - 1 WHERE points = OLD.points;
+                DELETE FROM points_histogram WHERE points = OLD.points AND n <= 0;
+                INSERT INTO points_histogram (points, n) SELECT NEW.points, 1 WHERE NEW.points IS NOT NULL
+                ON CONFLICT (points) DO UPDATE SET n = n + 1;
+            END
+        """)
 
-def set_config_value(key, value):
+def create_stock_count_triggers():
+    """
+    Keep platforms.stock_count equal to the platform's unclaimed stock_items.
+    Renames need no trigger: the count moves with the platforms row.
+    """
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("REPLACE INTO configurations (config_key, config_value) VALUES (?, ?)", (key, str(value)))
-    conn.commit()
-    c.close()
-    conn.close()
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stock_items_insert AFTER INSERT ON stock_items
+        WHEN NEW.claimed_by IS NULL BEGIN
+            UPDATE platforms SET stock_count = stock_count + 1 WHERE platform_name = NEW.platform_name;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stock_items_delete AFTER DELETE ON stock_items
+        WHEN OLD.claimed_by IS NULL BEGIN
+            UPDATE platforms SET stock_count = stock_count - 1 WHERE platform_name = OLD.platform_name;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stock_items_claim AFTER UPDATE OF claimed_by ON stock_items
+        WHEN (OLD.claimed_by IS NULL) != (NEW.claimed_by IS NULL) BEGIN
+            UPDATE platforms
+            SET stock_count = stock_count + CASE WHEN NEW.claimed_by IS NULL THEN 1 ELSE -1 END
+            WHERE platform_name = NEW.platform_name;
+        END
+    """)
+
+def _stock_item_content(item):
+    """
+    Flatten a legacy JSON stock entry into the text stored in stock_items.
+    Cookie entries keep only their file content; anything else that is not
+    a plain string is stored as its JSON encoding.
+    """
+    if isinstance(item, dict) and item.get("type") == "cookie":
+        return item.get("content", "")
+    if isinstance(item, str):
+        return item
+    return json.dumps(item)
+
+def migrate_stock_blobs():
+    """
+    One-time move of the legacy platforms.stock JSON arrays into stock_items.
+    Each platform is converted in its own transaction and its blob is reset
+    to '[]', so running this again is a no-op.
+    """
+    rows = get_connection().execute(
+        "SELECT platform_name, stock FROM platforms WHERE stock IS NOT NULL AND stock NOT IN ('', '[]')"
+    ).fetchall()
+    for platform_name, blob in rows:
+        try:
+            items = json.loads(blob)
+        except ValueError:
+            items = []
+        with transaction() as conn:
+            add_stock_items(platform_name, items)
+            conn.execute("UPDATE platforms SET stock = '[]' WHERE platform_name = ?", (platform_name,))
+        invalidate_platforms()
+
+def update_user_verified(telegram_id):
+    with transaction() as conn:
+        conn.execute("UPDATE users SET verified = 1 WHERE telegram_id = ?", (telegram_id,))
+
+# In-memory copy of the configurations table. Reads are served from here;
+# set_config_value() writes through to the table.
+_config_cache = None
+_config_lock = threading.Lock()
+# config key (or None for every key) -> callbacks taking (key, value)
+_config_subscribers = {}
+
+def load_config():
+    """(Re)load the configurations table into memory."""
+    global _config_cache
+    rows = get_connection().execute("SELECT config_key, config_value FROM configurations").fetchall()
+    with _config_lock:
+        _config_cache = {key: value for key, value in rows}
+
+def subscribe_config(callback, key=None):
+    """
+    Call callback(key, value) whenever a configuration value changes.
+    With key=None the callback fires for every key.
+    """
+    with _config_lock:
+        _config_subscribers.setdefault(key, []).append(callback)
+
+def set_config_value(key, value):
+    value = str(value)
+    with transaction() as conn:
+        conn.execute("REPLACE INTO configurations (config_key, config_value) VALUES (?, ?)", (key, value))
+    if _config_cache is None:
+        load_config()
+    with _config_lock:
+        changed = _config_cache.get(key) != value
+        _config_cache[key] = value
+        callbacks = _config_subscribers.get(key, []) + _config_subscribers.get(None, [])
+    if changed:
+        for callback in callbacks:
+            try:
+                callback(key, value)
+            except Exception as e:
+                print(f"Error in config subscriber for {key}: {e}")
 
 def get_config_value(key):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT config_value FROM configurations WHERE config_key = ?", (key,))
-    row = c.fetchone()
-    c.close()
-    conn.close()
-    return row[0] if row else None
+    if _config_cache is None:
+        load_config()
+    return _config_cache.get(key)
+
+def get_config_int(key, default):
+    """Return a configuration value as an int, or default when unset or malformed."""
+    value = get_config_value(key)
+    try:
+        return int(value) if value is not None else default
+    except ValueError:
+        return default
 
 def set_account_claim_cost(cost):
     set_config_value("account_claim_cost", cost)
 
 def get_account_claim_cost():
-    cost = get_config_value("account_claim_cost")
-    return int(cost) if cost is not None else config.DEFAULT_ACCOUNT_CLAIM_COST
+    return get_config_int("account_claim_cost", config.DEFAULT_ACCOUNT_CLAIM_COST)
 
 def set_referral_bonus(bonus):
     set_config_value("referral_bonus", bonus)
 
 def get_referral_bonus():
-    bonus = get_config_value("referral_bonus")
-    return int(bonus) if bonus is not None else config.DEFAULT_REFERRAL_BONUS
+    return get_config_int("referral_bonus", config.DEFAULT_REFERRAL_BONUS)
+
+# Platforms without their own price fall back to the claim cost.
+subscribe_config(lambda key, value: invalidate_platforms(), "account_claim_cost")
 
 def add_user(telegram_id, username, join_date, pending_referrer=None):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = c.fetchone()
-    if not user:
-        c.execute("""
-            INSERT INTO users (telegram_id, username, join_date, pending_referrer)
+    with transaction() as conn:
+        inserted = conn.execute("""
+            INSERT OR IGNORE INTO users (telegram_id, username, join_date, pending_referrer)
             VALUES (?, ?, ?, ?)
-        """, (telegram_id, username, join_date, pending_referrer))
-        conn.commit()
-    c.close()
-    conn.close()
-    return get_user(telegram_id)
+        """, (telegram_id, username, join_date, pending_referrer)).rowcount
+    user = get_user(telegram_id)
+    if inserted:
+        _note_balance_change(telegram_id, points=user["points"], referrals=user["referrals"])
+    return user
 
 def get_user(telegram_id):
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = c.fetchone()
-    c.close()
-    conn.close()
+    user = get_connection().execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
     return dict(user) if user else None
 
+# Sort name -> keyset expression; must match the users indexes exactly.
+USER_SORTS = {"join": "COALESCE(join_date, '')", "points": "points"}
+
+def get_users_page(sort="join", cursor=None, backwards=False, limit=10):
+    """
+    One keyset page of users, newest or richest first (sort column, then
+    telegram_id, both descending). cursor is the (sort_key, telegram_id) of
+    the row the page continues after, or before when backwards=True; every
+    row carries its sort_key. Returns (rows, has_more), has_more telling
+    whether the read direction continues.
+    """
+    column = USER_SORTS[sort]
+    where, params = "", ()
+    if cursor is not None:
+        where = f"WHERE ({column}, telegram_id) {'>' if backwards else '<'} (?, ?)"
+        params = tuple(cursor)
+    order = "ASC" if backwards else "DESC"
+    rows = get_connection().execute(f"""
+        SELECT telegram_id, username, join_date, points, banned, {column} AS sort_key FROM users {where}
+        ORDER BY {column} {order}, telegram_id {order} LIMIT ?
+    """, params + (limit + 1,)).fetchall()
+    rows = [dict(row) for row in rows]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    return rows, has_more
+
+def search_users(query, limit=10):
+    """
+    Find users whose id (all digits) or username starts with query,
+    using index range scans rather than LIKE.
+    """
+    query = query.strip().lstrip("@")
+    if not query:
+        return []
+    upper = query + "\uffff"
+    if query.isdigit():
+        sql = """
+            SELECT telegram_id, username, join_date, points, banned FROM users
+            WHERE telegram_id >= ? AND telegram_id < ? ORDER BY telegram_id LIMIT ?
+        """
+    else:
+        sql = """
+            SELECT telegram_id, username, join_date, points, banned FROM users
+            WHERE username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE
+            ORDER BY username COLLATE NOCASE LIMIT ?
+        """
+    return [dict(row) for row in get_connection().execute(sql, (query, upper, limit))]
+
 def update_user_points(telegram_id, new_points):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET points = ? WHERE telegram_id = ?", (new_points, telegram_id))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE users SET points = ? WHERE telegram_id = ?", (new_points, telegram_id))
+    _note_balance_change(telegram_id, points=new_points)
+
+def add_user_points(telegram_id, delta):
+    """
+    Add delta points to a balance in place, so concurrent claims and
+    redemptions are not overwritten. Returns the new balance, or None if
+    the user does not exist.
+    """
+    with transaction() as conn:
+        if not conn.execute("UPDATE users SET points = points + ? WHERE telegram_id = ?", (delta, telegram_id)).rowcount:
+            return None
+        balance = conn.execute("SELECT points FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()[0]
+    _note_balance_change(telegram_id, points=balance)
+    return balance
 
 def ban_user(telegram_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET banned = 1 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE users SET banned = 1 WHERE telegram_id = ?", (telegram_id,))
 
 def unban_user(telegram_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET banned = 0 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE users SET banned = 0 WHERE telegram_id = ?", (telegram_id,))
+
+def set_users_blocked(telegram_ids, blocked=True):
+    """Flag users who blocked the bot (or whose account is gone) so broadcasts skip them."""
+    with transaction() as conn:
+        conn.executemany("UPDATE users SET blocked = ? WHERE telegram_id = ?",
+                         [(1 if blocked else 0, telegram_id) for telegram_id in telegram_ids])
 
 def add_referral(referrer_id, referred_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM referrals WHERE referred_id = ?", (referred_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO referrals (user_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id))
-        conn.commit()
+    with transaction(immediate=True) as conn:
+        if conn.execute("SELECT 1 FROM referrals WHERE referred_id = ?", (referred_id,)).fetchone():
+            return
+        conn.execute("INSERT INTO referrals (user_id, referred_id, referred_at) VALUES (?, ?, ?)",
+                     (referrer_id, referred_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         bonus = get_referral_bonus()
-        c.execute("UPDATE users SET points = points + ?, referrals = referrals + 1 WHERE telegram_id = ?", (bonus, referrer_id))
-        conn.commit()
-    c.close()
-    conn.close()
+        conn.execute("UPDATE users SET points = points + ?, referrals = referrals + 1 WHERE telegram_id = ?", (bonus, referrer_id))
+    _note_balance_change(referrer_id, points=None, referrals=None)
+
+def get_downline(telegram_id, limit=50, offset=0):
+    """Users below telegram_id in the referral graph, nearest first: dicts with depth, username, join_date."""
+    rows = get_connection().execute("""
+        SELECT p.descendant AS telegram_id, p.depth, u.username, u.join_date, u.banned, r.referred_at
+        FROM referral_paths p
+        LEFT JOIN users u ON u.telegram_id = p.descendant
+        LEFT JOIN referrals r ON r.referred_id = p.descendant
+        WHERE p.ancestor = ?
+        ORDER BY p.depth, p.descendant
+        LIMIT ? OFFSET ?
+    """, (telegram_id, limit, offset))
+    return [dict(row) for row in rows]
+
+def get_direct_referrals(telegram_id, limit=20):
+    """A referrer's most recent direct referrals: dicts with telegram_id, username, banned, referred_at."""
+    rows = get_connection().execute("""
+        SELECT r.referred_id AS telegram_id, u.username, u.banned, r.referred_at
+        FROM referrals r LEFT JOIN users u ON u.telegram_id = r.referred_id
+        WHERE r.user_id = ?
+        ORDER BY r.referred_at DESC
+        LIMIT ?
+    """, (telegram_id, limit))
+    return [dict(row) for row in rows]
+
+def get_downline_stats(telegram_id):
+    """(size, max_depth, {depth: count}) of a user's whole downline."""
+    rows = get_connection().execute(
+        "SELECT depth, COUNT(*) FROM referral_paths WHERE ancestor = ? GROUP BY depth ORDER BY depth", (telegram_id,)
+    ).fetchall()
+    by_depth = {depth: count for depth, count in rows}
+    return sum(by_depth.values()), max(by_depth, default=0), by_depth
+
+def get_upline(telegram_id):
+    """Referrers above telegram_id, direct referrer first."""
+    rows = get_connection().execute(
+        "SELECT ancestor FROM referral_paths WHERE descendant = ? ORDER BY depth", (telegram_id,)
+    )
+    return [row[0] for row in rows]
+
+def get_referral_bursts(window_minutes=None, threshold=None, lookback_days=None, limit=20):
+    """
+    Referrers who brought in at least threshold users within window_minutes
+    of each other during the last lookback_days: dicts with telegram_id,
+    burst (largest such group), burst_end (when it peaked), recent
+    (referrals in the lookback) and downline (whole tree size), biggest
+    bursts first.
+    """
+    window = (window_minutes or config.REFERRAL_BURST_WINDOW_MINUTES) * 60
+    threshold = threshold or config.REFERRAL_BURST_THRESHOLD
+    since = (datetime.now() - timedelta(days=lookback_days or config.REFERRAL_BURST_LOOKBACK_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    # Only referrers with enough recent referrals to reach the threshold get
+    # the per-row window count. "+user_id" keeps the planner on the
+    # referred_at range instead of walking all of (user_id, referred_at).
+    rows = get_connection().execute("""
+        WITH candidates AS (
+            SELECT user_id FROM referrals WHERE referred_at >= ?2
+            GROUP BY +user_id HAVING COUNT(*) >= ?3
+        ),
+        recent AS (
+            SELECT r.user_id, r.referred_at,
+                   COUNT(*) OVER (
+                       PARTITION BY r.user_id ORDER BY CAST(strftime('%s', r.referred_at) AS INTEGER)
+                       RANGE BETWEEN ?1 PRECEDING AND CURRENT ROW
+                   ) AS burst
+            FROM candidates c JOIN referrals r ON r.user_id = c.user_id AND r.referred_at >= ?2
+        ),
+        bursts AS (
+            SELECT user_id, MAX(burst) AS burst, COUNT(*) AS recent FROM recent GROUP BY user_id
+        )
+        SELECT b.user_id AS telegram_id, b.burst, b.recent,
+               (SELECT MIN(referred_at) FROM recent r WHERE r.user_id = b.user_id AND r.burst = b.burst) AS burst_end,
+               (SELECT COUNT(*) FROM referral_paths p WHERE p.ancestor = b.user_id) AS downline
+        FROM bursts b
+        WHERE b.burst >= ?3
+        ORDER BY b.burst DESC, b.recent DESC
+        LIMIT ?4
+    """, (window, since, threshold, limit))
+    return [dict(row) for row in rows]
+
+def referral_burst_size(referrer_id, window_minutes=None):
+    """How many users referrer_id brought in during the last window_minutes."""
+    since = (datetime.now() - timedelta(minutes=window_minutes or config.REFERRAL_BURST_WINDOW_MINUTES)).strftime("%Y-%m-%d %H:%M:%S")
+    return get_connection().execute(
+        "SELECT COUNT(*) FROM referrals WHERE user_id = ? AND referred_at >= ?", (referrer_id, since)
+    ).fetchone()[0]
 
 def clear_pending_referral(telegram_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET pending_referrer = NULL WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE users SET pending_referrer = NULL WHERE telegram_id = ?", (telegram_id,))
 
 def add_review(user_id, review_text):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO reviews (user_id, review, timestamp) VALUES (?, ?, ?)", (user_id, review_text, datetime.now()))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("INSERT INTO reviews (user_id, review, timestamp) VALUES (?, ?, ?)", (user_id, review_text, datetime.now()))
 
 def log_admin_action(admin_id, action):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO admin_logs (admin_id, action, timestamp) VALUES (?, ?, ?)", (admin_id, action, datetime.now()))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("INSERT INTO admin_logs (admin_id, action, timestamp) VALUES (?, ?, ?)", (admin_id, action, datetime.now()))
 
 def get_admins():
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM admins")
-    admins = c.fetchall()
-    c.close()
-    conn.close()
-    return [dict(a) for a in admins]
+    return [dict(a) for a in get_connection().execute("SELECT * FROM admins")]
 
 def get_key(key_str):
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM keys WHERE \"key\" = ?", (key_str,))
-    key_doc = c.fetchone()
-    c.close()
-    conn.close()
+    key_doc = get_connection().execute("SELECT * FROM keys WHERE \"key\" = ?", (key_str,)).fetchone()
     return dict(key_doc) if key_doc else None
 
+# Every unclaimed key, loaded on first use and kept in step by add_key(s) and
+# claim_key_in_db(). A /redeem guess that is not in it is rejected without
+# touching SQLite. Exact (no false positives), at roughly 100 bytes a key.
+# The load holds the lock across its SELECT and new keys are added under it
+# after their commit, so keys inserted during a load are never lost.
+_unclaimed_keys = None
+_unclaimed_keys_lock = threading.Lock()
+
+def _unclaimed_key_set():
+    global _unclaimed_keys
+    keys = _unclaimed_keys
+    if keys is None:
+        with _unclaimed_keys_lock:
+            if _unclaimed_keys is None:
+                _unclaimed_keys = {row[0] for row in get_connection().execute('SELECT "key" FROM keys WHERE claimed = 0')}
+            keys = _unclaimed_keys
+    return keys
+
+def _note_new_keys(keys):
+    with _unclaimed_keys_lock:
+        if _unclaimed_keys is not None:
+            _unclaimed_keys.update(keys)
+
 def claim_key_in_db(key_str, telegram_id):
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM keys WHERE \"key\" = ?", (key_str,))
-    key_doc = c.fetchone()
-    if not key_doc:
-        c.close()
-        conn.close()
-        return "Key not found."
-    if key_doc["claimed"]:
-        c.close()
-        conn.close()
-        return "Key already claimed."
-    points_awarded = key_doc["points"]
-    c.execute("UPDATE keys SET claimed = 1, claimed_by = ?, timestamp = ? WHERE \"key\" = ?",
-              (telegram_id, datetime.now(), key_str))
-    conn.commit()
-    c.execute("UPDATE users SET points = points + ? WHERE telegram_id = ?", (points_awarded, telegram_id))
-    conn.commit()
-    c.close()
-    conn.close()
+    """
+    Redeem a key for a user. The credit and the claim are both conditional
+    on claimed = 0 and run in one BEGIN IMMEDIATE transaction, so a key pays
+    out exactly once however many users race for it.
+    """
+    keys = _unclaimed_key_set()
+    if key_str not in keys:
+        return "Key not found or already claimed."
+    with transaction(immediate=True) as conn:
+        credited = conn.execute("""
+            UPDATE users SET points = points + (SELECT points FROM keys WHERE "key" = ?1 AND claimed = 0)
+            WHERE telegram_id = ?2 AND EXISTS (SELECT 1 FROM keys WHERE "key" = ?1 AND claimed = 0)
+        """, (key_str, telegram_id)).rowcount
+        if not credited:
+            key_doc = conn.execute('SELECT claimed FROM keys WHERE "key" = ?', (key_str,)).fetchone()
+            if key_doc is None or key_doc["claimed"]:
+                keys.discard(key_str)
+                return "Key not found." if key_doc is None else "Key already claimed."
+            return "User not found. Please /start the bot first."
+        claimed = conn.execute('UPDATE keys SET claimed = 1, claimed_by = ?, timestamp = ? WHERE "key" = ? AND claimed = 0',
+                               (telegram_id, datetime.now(), key_str)).rowcount
+        if not claimed:
+            # Cannot happen while the write lock is held; undo the credit rather than pay twice.
+            raise sqlite3.IntegrityError(f"key {key_str} was claimed concurrently")
+        points_awarded = conn.execute('SELECT points FROM keys WHERE "key" = ?', (key_str,)).fetchone()[0]
+    keys.discard(key_str)
+    _note_balance_change(telegram_id, points=None)
     return f"Key redeemed successfully. You've been awarded {points_awarded} points."
 
 def add_key(key_str, key_type, points):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO keys (\"key\", type, points, claimed, claimed_by, timestamp) VALUES (?, ?, ?, 0, NULL, ?)",
-              (key_str, key_type, points, datetime.now()))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("INSERT INTO keys (\"key\", type, points, claimed, claimed_by, timestamp) VALUES (?, ?, ?, 0, NULL, ?)",
+                     (key_str, key_type, points, datetime.now()))
+    _note_new_keys([key_str])
+
+def add_keys(keys, key_type, points):
+    """
+    Insert many keys in one transaction, skipping any that already exist.
+    Returns the list of keys actually inserted.
+    """
+    keys = list(keys)
+    now = datetime.now()
+    existing = set()
+    with transaction(immediate=True) as conn:
+        # Chunked to stay under SQLite's bound-parameter limit.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            existing.update(row[0] for row in conn.execute(f"SELECT \"key\" FROM keys WHERE \"key\" IN ({placeholders})", chunk))
+        fresh = [k for k in keys if k not in existing]
+        conn.executemany("INSERT INTO keys (\"key\", type, points, claimed, claimed_by, timestamp) VALUES (?, ?, ?, 0, NULL, ?)",
+                         [(k, key_type, points, now) for k in fresh])
+    _note_new_keys(fresh)
+    return fresh
 
 def get_keys():
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM keys")
-    keys = c.fetchall()
-    c.close()
-    conn.close()
-    return [dict(k) for k in keys]
-
-def get_leaderboard(limit=10):
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT telegram_id, username, points FROM users ORDER BY points DESC LIMIT ?", (limit,))
-    leaderboard = c.fetchall()
-    c.close()
-    conn.close()
-    return [dict(row) for row in leaderboard]
+    return [dict(k) for k in get_connection().execute("SELECT * FROM keys")]
+
+# Cached top-N per leaderboard, keyed by the users column it ranks.
+LEADERBOARD_SIZE = 10
+_leaderboards = {"points": None, "referrals": None}
+# Bumped whenever a board may have changed; a board read while its version
+# moved is not cached (see get_leaderboard()).
+_leaderboard_versions = {"points": 0, "referrals": 0}
+_leaderboards_lock = threading.Lock()
+
+# Default for a column the change did not touch; its board is left alone.
+_UNCHANGED = object()
+
+def _note_balance_change(telegram_id, points=_UNCHANGED, referrals=_UNCHANGED):
+    """
+    Drop a cached leaderboard only when the change can affect it: the user
+    is on it, or their new value reaches its cutoff (None means changed to
+    an unknown value). Call after the change is committed.
+    """
+    with _leaderboards_lock:
+        for column, value in (("points", points), ("referrals", referrals)):
+            if value is _UNCHANGED:
+                continue
+            board = _leaderboards[column]
+            if (board is None or value is None or len(board) < LEADERBOARD_SIZE or value >= board[-1][column]
+                    or any(row["telegram_id"] == telegram_id for row in board)):
+                # With no board cached, a reader may be building one right now.
+                _leaderboards[column] = None
+                _leaderboard_versions[column] += 1
+
+def get_leaderboard(limit=10, by="points"):
+    """Top users by 'points' or 'referrals', served from cache for limit <= LEADERBOARD_SIZE."""
+    if by not in _leaderboards:
+        raise ValueError(f"unknown leaderboard: {by}")
+    if limit > LEADERBOARD_SIZE:
+        rows = get_connection().execute(
+            f"SELECT telegram_id, username, points, referrals FROM users ORDER BY {by} DESC, telegram_id DESC LIMIT ?", (limit,)
+        )
+        return [dict(row) for row in rows]
+    board = _leaderboards[by]
+    if board is None:
+        with _leaderboards_lock:
+            version = _leaderboard_versions[by]
+        rows = get_connection().execute(
+            f"SELECT telegram_id, username, points, referrals FROM users ORDER BY {by} DESC, telegram_id DESC LIMIT ?",
+            (LEADERBOARD_SIZE,)
+        )
+        board = [dict(row) for row in rows]
+        with _leaderboards_lock:
+            # A balance changed while we read; the next call reads again.
+            if version == _leaderboard_versions[by]:
+                _leaderboards[by] = board
+    return board[:limit]
+
+def get_points_rank(points):
+    """1-based rank of a balance among all users (ties share a rank)."""
+    row = get_connection().execute("SELECT COALESCE(SUM(n), 0) FROM points_histogram WHERE points > ?", (points,)).fetchone()
+    return row[0] + 1
+
+BROADCAST_STATUS_RUNNING = "running"
+BROADCAST_STATUS_DONE = "done"
+BROADCAST_STATUS_CANCELLED = "cancelled"
+
+def create_broadcast(owner_id, from_chat_id, message_id, progress_chat_id, progress_message_id):
+    """Record a new broadcast of one message to every reachable user; returns its row."""
+    # Immediate: a deferred read-then-write can fail with SQLITE_BUSY_SNAPSHOT under WAL.
+    with transaction(immediate=True) as conn:
+        total = conn.execute("SELECT COUNT(*) FROM users WHERE banned = 0 AND blocked = 0").fetchone()[0]
+        broadcast_id = conn.execute("""
+            INSERT INTO broadcasts (owner_id, from_chat_id, message_id, progress_chat_id, progress_message_id, total, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (owner_id, from_chat_id, message_id, progress_chat_id, progress_message_id, total,
+              datetime.now().strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
+    return get_broadcast(broadcast_id)
+
+def get_broadcast(broadcast_id):
+    row = get_connection().execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_running_broadcasts():
+    rows = get_connection().execute("SELECT * FROM broadcasts WHERE status = ? ORDER BY id", (BROADCAST_STATUS_RUNNING,))
+    return [dict(row) for row in rows]
+
+def get_broadcast_recipients(cursor=None, limit=500):
+    """Next keyset batch of reachable user ids after cursor, in telegram_id order."""
+    rows = get_connection().execute("""
+        SELECT telegram_id FROM users
+        WHERE telegram_id > ? AND banned = 0 AND blocked = 0
+        ORDER BY telegram_id LIMIT ?
+    """, (cursor or "", limit))
+    return [row[0] for row in rows]
+
+def checkpoint_broadcast(broadcast_id, cursor, sent, failed, blocked):
+    """Store the progress of a finished batch; a restart continues after cursor."""
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE broadcasts SET cursor = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+            WHERE id = ?
+        """, (cursor, sent, failed, blocked, broadcast_id))
+
+def finish_broadcast(broadcast_id, status=BROADCAST_STATUS_DONE):
+    with transaction() as conn:
+        conn.execute("UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                     (status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), broadcast_id, BROADCAST_STATUS_RUNNING))
 
 def get_admin_dashboard():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE banned = 1")
-    banned_users = c.fetchone()[0]
-    c.execute("SELECT SUM(points) FROM users")
-    total_points = c.fetchone()[0] or 0
-    c.close()
-    conn.close()
-    return total_users, banned_users, total_points
+    """(total_users, banned_users, total_points) from the trigger-maintained user_stats row."""
+    row = get_connection().execute("SELECT total_users, banned_users, total_points FROM user_stats WHERE id = 1").fetchone()
+    return tuple(row) if row else (0, 0, 0)
+
+def get_dashboard_history(days=7):
+    """Daily end-of-day snapshots for the last `days` days with activity, oldest first."""
+    rows = get_connection().execute(
+        "SELECT day, total_users, banned_users, total_points FROM user_stats_daily ORDER BY day DESC LIMIT ?", (days,)
+    ).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+# Snapshot of the platforms table keyed by name, rebuilt after any change to a
+# platform's name, price or stock count. platforms_version() lets callers
+# cache things derived from it, such as the rewards keyboard.
+_platforms_cache = None
+_platforms_version = 0
+_platforms_lock = threading.Lock()
+
+def invalidate_platforms():
+    global _platforms_cache, _platforms_version
+    with _platforms_lock:
+        _platforms_cache = None
+        _platforms_version += 1
+
+def platforms_version():
+    return _platforms_version
+
+def _platforms_snapshot():
+    global _platforms_cache
+    cache = _platforms_cache
+    if cache is None:
+        with _platforms_lock:
+            version = _platforms_version
+        rows = get_connection().execute("SELECT * FROM platforms ORDER BY rowid").fetchall()
+        cache = {row["platform_name"]: dict(row) for row in rows}
+        with _platforms_lock:
+            # Only publish if nothing changed while we were reading.
+            if version == _platforms_version:
+                _platforms_cache = cache
+    return cache
 
 def get_platforms():
+    """
+    Return every platform, including its unclaimed item count as 'stock_count'.
+    Served from the in-memory snapshot.
+    """
+    return [dict(p) for p in _platforms_snapshot().values()]
+
+def get_platform(platform_name):
+    platform = _platforms_snapshot().get(platform_name)
+    return dict(platform) if platform else None
+
+def get_stock_count(platform_name):
+    row = get_connection().execute("SELECT stock_count FROM platforms WHERE platform_name = ?", (platform_name,)).fetchone()
+    return row[0] if row else 0
+
+def stock_hash(content):
+    """Content hash used for duplicate detection; ignores surrounding whitespace."""
+    return hashlib.blake2b(content.strip().encode("utf-8"), digest_size=16).digest()
+
+def _existing_stock_hashes(conn, platform_name, hashes):
+    """
+    Return which of hashes are already stored, in the platform or, with
+    STOCK_DEDUP_SCOPE = "global", in any platform. Claimed rows count too, so
+    an account that was handed out once cannot be sold again.
+    """
+    found = set()
+    scope_global = config.STOCK_DEDUP_SCOPE == "global"
+    # Chunked to stay under SQLite's bound-parameter limit.
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        if scope_global:
+            rows = conn.execute(f"SELECT content_hash FROM stock_items WHERE content_hash IN ({placeholders})", chunk)
+        else:
+            rows = conn.execute(
+                f"SELECT content_hash FROM stock_items WHERE content_hash IN ({placeholders}) AND platform_name = ?",
+                chunk + [platform_name]
+            )
+        found.update(row[0] for row in rows)
+    return found
+
+def add_stock_items(platform_name, items):
+    """
+    Append items (plain strings or legacy cookie dicts) to a platform's stock,
+    skipping duplicates of each other and of stored items.
+    Returns (added, duplicates).
+    """
+    now = datetime.now()
+    rows = []
+    seen = set()
+    for item in items:
+        content = _stock_item_content(item)
+        digest = stock_hash(content)
+        if digest in seen:
+            continue
+        seen.add(digest)
+        rows.append((platform_name, content, digest, now))
+    with transaction(immediate=True) as conn:
+        existing = _existing_stock_hashes(conn, platform_name, [row[2] for row in rows])
+        rows = [row for row in rows if row[2] not in existing]
+        conn.executemany("INSERT INTO stock_items (platform_name, content, content_hash, added_at) VALUES (?, ?, ?, ?)", rows)
+    invalidate_platforms()
+    return len(rows), len(items) - len(rows)
+
+def backfill_stock_hashes(batch_size=5000):
+    """
+    Compute content_hash for rows stored before it existed.
+    Returns the number of rows updated.
+    """
+    updated = 0
     conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM platforms")
-    platforms = c.fetchall()
-    c.close()
-    conn.close()
-    return [dict(p) for p in platforms]
+    while True:
+        rows = conn.execute("SELECT id, content FROM stock_items WHERE content_hash IS NULL LIMIT ?", (batch_size,)).fetchall()
+        if not rows:
+            return updated
+        with transaction():
+            conn.executemany("UPDATE stock_items SET content_hash = ? WHERE id = ?",
+                             [(stock_hash(row["content"]), row["id"]) for row in rows])
+        updated += len(rows)
+
+def remove_duplicate_stock():
+    """
+    Delete unclaimed items whose content is already stored, keeping the
+    oldest copy; an unclaimed copy of a claimed item is removed as well.
+    Returns the number of rows deleted.
+    """
+    same_scope = "" if config.STOCK_DEDUP_SCOPE == "global" else "AND o.platform_name = s.platform_name"
+    with transaction(immediate=True) as conn:
+        removed = conn.execute(f"""
+            DELETE FROM stock_items AS s
+            WHERE s.claimed_by IS NULL AND EXISTS (
+                SELECT 1 FROM stock_items o
+                WHERE o.content_hash = s.content_hash {same_scope}
+                  AND o.id != s.id AND (o.claimed_by IS NOT NULL OR o.id < s.id)
+            )
+        """).rowcount
+    invalidate_platforms()
+    return removed
+
+# Outcomes of claim_stock().
+CLAIM_OK = "ok"
+CLAIM_INSUFFICIENT = "insufficient"
+CLAIM_EMPTY = "empty"
+CLAIM_NOT_FOUND = "not_found"
+CLAIM_NO_USER = "no_user"
+
+ClaimResult = namedtuple("ClaimResult", ["status", "item", "price", "balance"])
+
+def claim_stock(telegram_id, platform_name):
+    """
+    Charge a user for one item of a platform and hand it out, atomically.
+
+    The price lookup, stock take and point deduction all run in a single
+    BEGIN IMMEDIATE transaction, and both writes are conditional
+    (claimed_by IS NULL, points >= price), so concurrent claims can neither
+    overspend a balance nor receive the same item. Returns a ClaimResult whose
+    status is one of the CLAIM_* constants; item and balance are only set on
+    CLAIM_OK. Cookie platforms get the {"type": "cookie", "content": ...}
+    shape the delivery code expects.
+    """
+    with transaction(immediate=True) as conn:
+        platform = conn.execute(
+            "SELECT price, platform_type FROM platforms WHERE platform_name = ?", (platform_name,)
+        ).fetchone()
+        if not platform:
+            return ClaimResult(CLAIM_NOT_FOUND, None, None, None)
+        price = platform["price"] or get_account_claim_cost()
+        row = conn.execute("""
+            SELECT id, content FROM stock_items
+            WHERE platform_name = ? AND claimed_by IS NULL
+            ORDER BY id LIMIT 1
+        """, (platform_name,)).fetchone()
+        if not row:
+            return ClaimResult(CLAIM_EMPTY, None, price, None)
+        charged = conn.execute(
+            "UPDATE users SET points = points - ? WHERE telegram_id = ? AND points >= ?",
+            (price, telegram_id, price)
+        ).rowcount
+        if not charged:
+            exists = conn.execute("SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+            return ClaimResult(CLAIM_INSUFFICIENT if exists else CLAIM_NO_USER, None, price, None)
+        taken = conn.execute(
+            "UPDATE stock_items SET claimed_by = ?, claimed_at = ? WHERE id = ? AND claimed_by IS NULL",
+            (telegram_id, datetime.now(), row["id"])
+        ).rowcount
+        if not taken:
+            # Cannot happen while the write lock is held; undo the charge rather than sell nothing.
+            raise sqlite3.IntegrityError(f"stock item {row['id']} was claimed concurrently")
+        balance = conn.execute("SELECT points FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()[0]
+    invalidate_platforms()
+    _note_balance_change(telegram_id, points=balance)
+    item = row["content"]
+    if platform["platform_type"] == "cookie":
+        item = {"type": "cookie", "content": item}
+    return ClaimResult(CLAIM_OK, item, price, balance)
 
 def update_stock_for_platform(platform_name, stock):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE platforms SET stock = ? WHERE platform_name = ?", (json.dumps(stock), platform_name))
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "stock", f"Platform '{platform_name}' stock updated to {len(stock)} items.")
+    """
+    Replace the unclaimed stock of a platform with the given items.
+    Claimed rows are kept for the claim history.
+    """
+    with transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM stock_items WHERE platform_name = ? AND claimed_by IS NULL", (platform_name,))
+        added, _ = add_stock_items(platform_name, stock)
+    invalidate_platforms()
+    log_event(None, "stock", f"Platform '{platform_name}' stock updated to {added} items.")
 
 def rename_platform(old_name, new_name):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE platforms SET platform_name = ? WHERE platform_name = ?", (new_name, old_name))
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "platform", f"Platform renamed from '{old_name}' to '{new_name}'.")
+    with transaction() as conn:
+        conn.execute("UPDATE platforms SET platform_name = ? WHERE platform_name = ?", (new_name, old_name))
+        conn.execute("UPDATE stock_items SET platform_name = ? WHERE platform_name = ?", (new_name, old_name))
+    invalidate_platforms()
+    log_event(None, "platform", f"Platform renamed from '{old_name}' to '{new_name}'.")
 
 def update_platform_price(platform_name, new_price):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE platforms SET price = ? WHERE platform_name = ?", (new_price, platform_name))
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "platform", f"Platform '{platform_name}' price updated to {new_price} pts.")
+    with transaction() as conn:
+        conn.execute("UPDATE platforms SET price = ? WHERE platform_name = ?", (new_price, platform_name))
+    invalidate_platforms()
+    log_event(None, "platform", f"Platform '{platform_name}' price updated to {new_price} pts.")
+
+# ---------------- Backups ----------------
+
+# Tables every backup has had since the first schema; newer ones (stock_items,
+# user_stats, ...) are created by migrate() after the restore.
+REQUIRED_TABLES = {"users", "platforms", "keys", "configurations", "admins", "channels"}
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def backup_database(path, compress=True):
+    """
+    Write a consistent snapshot of the live database to path using SQLite's
+    online backup API, which copies pages under a read transaction and is
+    safe while other threads write. With compress the file is gzipped.
+    """
+    fd, raw_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        dst = sqlite3.connect(raw_path)
+        try:
+            get_connection().backup(dst)
+        finally:
+            dst.close()
+        if compress:
+            with open(raw_path, "rb") as src, gzip.open(path, "wb", compresslevel=6) as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+        else:
+            os.replace(raw_path, path)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    return path
+
+def rotate_backups(directory, keep):
+    """Snapshot into directory as bot-<timestamp>.db.gz and delete all but the newest keep."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"bot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db.gz")
+    backup_database(path)
+    backups = sorted(name for name in os.listdir(directory) if name.startswith("bot-") and name.endswith(".db.gz"))
+    for name in backups[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(directory, name))
+    return path
+
+def validate_database(path):
+    """
+    Open a candidate database file and return None if it is usable, or the
+    reason it is not: not SQLite, failed integrity_check, missing tables or
+    a schema newer than this code.
+    """
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        return f"cannot open: {e}"
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            return f"integrity check failed: {result}"
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = REQUIRED_TABLES - tables
+        if missing:
+            return f"missing tables: {', '.join(sorted(missing))}"
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            return f"schema version {version} is newer than this bot's ({SCHEMA_VERSION})"
+    except sqlite3.DatabaseError as e:
+        return f"not a valid database: {e}"
+    finally:
+        conn.close()
+    return None
+
+def restore_database(path):
+    """
+    Replace the live database with the (optionally gzipped) file at path.
+
+    The file is unpacked and validated first. It is then copied into the live
+    database with the backup API in a single step, which is one write
+    transaction: other connections see either the old or the new data, never
+    a mix, and none of them has to be reopened. Afterwards the schema is
+    migrated forward and the in-memory caches are reloaded. Returns None on
+    success or the reason the file was rejected.
+    """
+    fd, raw_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(DATABASE)))
+    os.close(fd)
+    try:
+        with open(path, "rb") as f:
+            compressed = f.read(2) == GZIP_MAGIC
+        with (gzip.open(path, "rb") if compressed else open(path, "rb")) as src, open(raw_path, "wb") as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+        error = validate_database(raw_path)
+        if error:
+            return error
+        src = sqlite3.connect(raw_path)
+        try:
+            src.backup(get_connection())
+        finally:
+            src.close()
+    except (OSError, EOFError, sqlite3.Error) as e:
+        return str(e)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    # Bring an older backup up to the current schema.
+    init_db()
+    reset_caches()
+    log_event(None, "database", "Database restored from backup.")
+    return None
+
+def reset_caches():
+    """Reload every in-memory copy of table data after the database was replaced."""
+    global _unclaimed_keys
+    load_config()
+    invalidate_platforms()
+    with _leaderboards_lock:
+        for column in _leaderboards:
+            _leaderboards[column] = None
+            _leaderboard_versions[column] += 1
+    with _unclaimed_keys_lock:
+        _unclaimed_keys = None
 
 if __name__ == '__main__':
     init_db()
-    
@@ -1,6 +1,6 @@
 # account_info.py
 import telebot
-from db import get_user, add_user
+from db import get_user, add_user, get_points_rank
 from datetime import datetime
 
 def send_account_info(bot, update):
@@ -38,6 +38,7 @@ def send_account_info(bot, update):
     join_date = user.get("join_date", "N/A")
     balance = user.get("points", 0)
     referrals = user.get("referrals", 0)
+    rank = get_points_rank(balance)
 
     # Build the fancy UI box
     text = (
@@ -47,6 +48,7 @@ def send_account_info(bot, update):
         f"┃ ✧ User ID: {telegram_id}\n"
         f"┃ ✧ Join Date: {join_date}\n"
         f"┃ ✧ Balance: {balance} pts\n"
+        f"┃ ✧ Rank: #{rank}\n"
         f"┃ ✧ Total Referrals: {referrals}\n"
         "┃\n"
         "╰━━━━━━━✦✧✦━━━━━━━╯"
@@ -1,31 +1,66 @@
-import sqlite3
-import json
+import html
+import secrets
+import string
+import threading
+import time
+import requests
 import config
 from datetime import datetime
 from telebot import types
 import telebot
 from db import (
     get_user,
+    get_connection,
+    transaction,
     ban_user,
     unban_user,
-    update_user_points,
+    add_user_points,
     get_account_claim_cost,
     get_admins,
     get_platforms,
+    get_platform,
+    invalidate_platforms,
+    get_users_page,
+    search_users,
     rename_platform,
     update_platform_price,
+    get_admin_dashboard,
+    get_dashboard_history,
+    get_referral_bursts,
+    get_direct_referrals,
+    get_downline,
+    get_downline_stats,
+    get_upline,
 )
 from handlers.logs import log_event
-
-# IMPORTANT: If you encounter an error such as "table platforms has no column named platform_type",
-# it means your existing DB file was created before adding the new column.
-# To fix this, run a migration (for example, using the sqlite3 command-line):
-#   ALTER TABLE platforms ADD COLUMN platform_type TEXT DEFAULT 'account';
-# Or delete/reinitialize your DB if possible.
+from handlers.router import callbacks
+from handlers.outbox import outbox
 
 # ----------------- ADMIN CHECK -----------------
 
+# Frozen set of user ids with admin rights; None until first use or after invalidation.
+_admin_ids = None
+_admin_ids_lock = threading.Lock()
+
+def _load_admin_ids():
+    """
+    Owners, config admins and the admins table, minus admins whose row is banned.
+    Owners cannot be banned.
+    """
+    table_admins = set()
+    banned = set()
+    for admin in get_admins():
+        (banned if admin.get("banned") else table_admins).add(str(admin.get("user_id")))
+    return frozenset(config.OWNERS) | frozenset((set(config.ADMINS) | table_admins) - banned)
+
+def invalidate_admin_cache():
+    """Drop the cached admin set; the next is_admin() call reloads it."""
+    global _admin_ids
+    with _admin_ids_lock:
+        _admin_ids = None
+
 def is_admin(user_or_id):
+    global _admin_ids
     try:
         if isinstance(user_or_id, dict):
             user_id = str(user_or_id.get("telegram_id"))
@@ -33,23 +68,38 @@ def is_admin(user_or_id):
             user_id = str(user_or_id.id)
     except AttributeError:
         user_id = str(user_or_id)
-    db_admins = get_admins()
-    db_admin_ids = [admin.get("user_id") for admin in db_admins]
-    return user_id in config.OWNERS or user_id in db_admin_ids
+    admin_ids = _admin_ids
+    if admin_ids is None:
+        with _admin_ids_lock:
+            if _admin_ids is None:
+                _admin_ids = _load_admin_ids()
+            admin_ids = _admin_ids
+    return user_id in admin_ids
+
+def require_admin(bot, call):
+    """Router guard for admin-panel callbacks."""
+    if is_admin(call.from_user):
+        return True
+    bot.answer_callback_query(call.id, "Access prohibited.")
+    return False
+
+def require_owner(bot, call):
+    """Router guard for owner-only callbacks."""
+    if str(call.from_user.id) in config.OWNERS:
+        return True
+    bot.answer_callback_query(call.id, "Access prohibited.")
+    return False
 
 # ----------------- LEND POINTS -----------------
 
-def lend_points(admin_id, user_id, points, custom_message=None):
-    user = get_user(user_id)
-    if not user:
+def lend_points(bot, admin_id, user_id, points, custom_message=None):
+    new_balance = add_user_points(user_id, points)
+    if new_balance is None:
         return f"User '{user_id}' not found."
-    new_balance = user["points"] + points
-    update_user_points(user_id, new_balance)
-    log_event(telebot.TeleBot(config.TOKEN), "lend", f"Admin {admin_id} lent {points} points to user {user_id}.")
-    bot_instance = telebot.TeleBot(config.TOKEN)
+    log_event(bot, "lend", f"Admin {admin_id} lent {points} points to user {user_id}.")
     msg = custom_message if custom_message else f"You have been lent {points} points. Your new balance is {new_balance} points."
     try:
-        bot_instance.send_message(user_id, msg)
+        bot.send_message(user_id, msg)
     except Exception as e:
         print(f"Error sending message to user {user_id}: {e}")
     return f"{points} points have been added to user {user_id}. New balance: {new_balance} points."
@@ -59,27 +109,47 @@ def lend_points(admin_id, user_id, points, custom_message=None):
 def update_account_claim_cost(cost):
     from db import set_config_value
     set_config_value("account_claim_cost", cost)
-    log_event(telebot.TeleBot(config.TOKEN), "config", f"Account claim cost updated to {cost} pts.")
+    log_event(None, "config", f"Account claim cost updated to {cost} pts.")
 
 def update_referral_bonus(bonus):
     from db import set_config_value
     set_config_value("referral_bonus", bonus)
-    log_event(telebot.TeleBot(config.TOKEN), "config", f"Referral bonus updated to {bonus} pts.")
+    log_event(None, "config", f"Referral bonus updated to {bonus} pts.")
 
 # ----------------- KEY GENERATION AND ADDITION -----------------
 
+KEY_ALPHABET = string.ascii_uppercase + string.digits
+KEY_PREFIXES = {"normal": "NKEY-", "premium": "PKEY-"}
+
+def _random_key(prefix):
+    return prefix + ''.join(secrets.choice(KEY_ALPHABET) for _ in range(10))
+
 def generate_normal_key():
-    import random, string
-    return "NKEY-" + ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+    return _random_key(KEY_PREFIXES["normal"])
 
 def generate_premium_key():
-    import random, string
-    return "PKEY-" + ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+    return _random_key(KEY_PREFIXES["premium"])
 
 def add_key(key_str, key_type, points):
     from db import add_key as db_add_key  # Assumes your db.py contains an add_key() function.
     db_add_key(key_str, key_type, points)
-    log_event(telebot.TeleBot(config.TOKEN), "key", f"Key {key_str} ({key_type}) added with {points} pts.")
+    log_event(None, "key", f"Key {key_str} ({key_type}) added with {points} pts.")
+
+def generate_keys(admin_id, key_type, qty, points):
+    """
+    Generate qty unique keys of key_type and store them in one transaction.
+    Keys that collide with existing ones are regenerated. Logs one summary line.
+    """
+    from db import add_keys
+    prefix = KEY_PREFIXES[key_type]
+    generated = []
+    while len(generated) < qty:
+        batch = set()
+        while len(batch) < qty - len(generated):
+            batch.add(_random_key(prefix))
+        generated.extend(add_keys(batch, key_type, points))
+    log_event(None, "key", f"Admin {admin_id} generated {len(generated)} {key_type} key(s) worth {points} pts each.")
+    return generated
 
 # ----------------- PLATFORM MANAGEMENT -----------------
 
@@ -87,33 +157,26 @@ def add_platform(platform_name, price, platform_type="account"):
     """
     Add a new platform with a custom price and type.
     """
-    conn = __import__('db').get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM platforms WHERE platform_name = ?", (platform_name,))
-    if c.fetchone():
-        c.close()
-        conn.close()
-        return f"Platform '{platform_name}' already exists."
-    c.execute(
-        "INSERT INTO platforms (platform_name, stock, price, platform_type) VALUES (?, ?, ?, ?)", 
-        (platform_name, "[]", price, platform_type)
-    )
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "platform", 
+    with transaction(immediate=True) as conn:
+        if conn.execute("SELECT 1 FROM platforms WHERE platform_name = ?", (platform_name,)).fetchone():
+            return f"Platform '{platform_name}' already exists."
+        conn.execute(
+            "INSERT INTO platforms (platform_name, stock, price, platform_type) VALUES (?, ?, ?, ?)", 
+            (platform_name, "[]", price, platform_type)
+        )
+    invalidate_platforms()
+    log_event(None, "platform", 
               f"Platform '{platform_name}' added with price {price} pts. Type: {platform_type}.")
     return None
 
 def remove_platform(platform_name):
-    conn = __import__('db').get_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM platforms WHERE platform_name = ?", (platform_name,))
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "platform", f"Platform '{platform_name}' removed.")
+    with transaction() as conn:
+        conn.execute("DELETE FROM platforms WHERE platform_name = ?", (platform_name,))
+        conn.execute("DELETE FROM stock_items WHERE platform_name = ?", (platform_name,))
+    invalidate_platforms()
+    log_event(None, "platform", f"Platform '{platform_name}' removed.")
 
+@callbacks.route("admin_platform", guard=require_admin)
 def handle_admin_platform(bot, call):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -134,6 +197,7 @@ def handle_admin_platform(bot, call):
 
 # ---- ADD PLATFORM FLOW (Sub-menu for Account vs Cookie) ----
 
+@callbacks.route("admin_platform_add", guard=require_admin)
 def handle_admin_platform_add(bot, call):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -149,6 +213,16 @@ def handle_admin_platform_add(bot, call):
     except Exception:
         bot.send_message(call.message.chat.id, "Select platform type to add:", reply_markup=markup)
 
+@callbacks.route("admin_platform_add_account", guard=require_admin)
+def handle_admin_platform_add_account(bot, call):
+    msg = bot.send_message(call.message.chat.id, "Please send the account platform name:")
+    bot.register_next_step_handler(msg, lambda m: process_account_platform_name(bot, m))
+
+@callbacks.route("admin_platform_add_cookie", guard=require_admin)
+def handle_admin_platform_add_cookie(bot, call):
+    msg = bot.send_message(call.message.chat.id, "Please send the cookie platform name:")
+    bot.register_next_step_handler(msg, lambda m: process_cookie_platform_name(bot, m))
+
 def process_account_platform_name(bot, message):
     platform_name = message.text.strip()
     msg = bot.send_message(message.chat.id, f"Enter the price for account platform '{platform_name}':")
@@ -181,8 +255,31 @@ def process_cookie_platform_price(bot, message, platform_name):
     bot.send_message(message.chat.id, response)
     send_admin_menu(bot, message)
 
+# ---- Remove Platform ----
+
+@callbacks.route("admin_platform_remove", guard=require_admin)
+def handle_admin_platform_remove(bot, call):
+    platforms = get_platforms()
+    if not platforms:
+        bot.answer_callback_query(call.id, "No platforms to remove.")
+        return
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for plat in platforms:
+        plat_name = plat.get("platform_name")
+        markup.add(types.InlineKeyboardButton(plat_name, callback_data=f"admin_platform_rm_{plat_name}"))
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_platform"))
+    bot.edit_message_text("Select a platform to remove:", chat_id=call.message.chat.id,
+                          message_id=call.message.message_id, reply_markup=markup)
+
+@callbacks.route("admin_platform_rm_<platform_name>", guard=require_admin)
+def handle_admin_platform_rm(bot, call, platform_name):
+    remove_platform(platform_name)
+    bot.answer_callback_query(call.id, f"Platform '{platform_name}' removed.")
+    handle_admin_platform(bot, call)
+
 # ---- Rename Platform ----
 
+@callbacks.route("admin_platform_rename", guard=require_admin)
 def handle_admin_platform_rename(bot, call):
     platforms = get_platforms()
     if not platforms:
@@ -198,6 +295,11 @@ def handle_admin_platform_rename(bot, call):
                           message_id=call.message.message_id, 
                           reply_markup=markup)
 
+@callbacks.route("admin_platform_rename_<old_name>", guard=require_admin)
+def handle_admin_platform_rename_pick(bot, call, old_name):
+    msg = bot.send_message(call.message.chat.id, f"Send new name for platform '{old_name}':")
+    bot.register_next_step_handler(msg, lambda m: process_platform_rename(bot, m, old_name))
+
 def process_platform_rename(bot, message, old_name):
     new_name = message.text.strip()
     rename_platform(old_name, new_name)
@@ -206,6 +308,7 @@ def process_platform_rename(bot, message, old_name):
 
 # ---- Change Price ----
 
+@callbacks.route("admin_platform_change_price", guard=require_admin)
 def handle_admin_platform_change_price(bot, call):
     platforms = get_platforms()
     if not platforms:
@@ -221,6 +324,11 @@ def handle_admin_platform_change_price(bot, call):
                           message_id=call.message.message_id, 
                           reply_markup=markup)
 
+@callbacks.route("admin_platform_change_price_<platform_name>", guard=require_admin)
+def handle_admin_platform_change_price_pick(bot, call, platform_name):
+    msg = bot.send_message(call.message.chat.id, f"Send new price for platform '{platform_name}':")
+    bot.register_next_step_handler(msg, lambda m: process_platform_change_price(bot, m, platform_name))
+
 def process_platform_change_price(bot, message, platform_name):
     try:
         price = int(message.text.strip())
@@ -233,6 +341,7 @@ def process_platform_change_price(bot, message, platform_name):
 
 # ---- Platform List ----
 
+@callbacks.route("admin_platform_list", guard=require_admin)
 def handle_admin_platform_list(bot, call):
     platforms = get_platforms()
     if not platforms:
@@ -241,15 +350,15 @@ def handle_admin_platform_list(bot, call):
     text = "Platforms:\n"
     for plat in platforms:
         plat_name = plat.get("platform_name")
-        stock = json.loads(plat.get("stock") or "[]")
         price = plat.get("price")
         p_type = plat.get("platform_type", "account")
-        text += f"• {plat_name} | Type: {p_type} | Stock: {len(stock)} | Price: {price} pts\n"
+        text += f"• {plat_name} | Type: {p_type} | Stock: {plat.get('stock_count', 0)} | Price: {price} pts\n"
     text += "\n🔙 /back to return."
     bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id)
 
 # ----------------- STOCK MANAGEMENT -----------------
 
+@callbacks.route("admin_stock", guard=require_admin)
 def handle_admin_stock(bot, call):
     platforms = get_platforms()
     if not platforms:
@@ -259,32 +368,33 @@ def handle_admin_stock(bot, call):
     for plat in platforms:
         plat_name = plat.get("platform_name")
         markup.add(types.InlineKeyboardButton(plat_name, callback_data=f"admin_stock_detail_{plat_name}"))
+    markup.add(types.InlineKeyboardButton("🧹 Remove Duplicates", callback_data="admin_stock_dedupe"))
     markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="back_main"))
     bot.edit_message_text("Select a platform to manage stock:", 
                           chat_id=call.message.chat.id,
                           message_id=call.message.message_id, 
                           reply_markup=markup)
 
+@callbacks.route("admin_stock_dedupe", guard=require_admin)
+def handle_admin_stock_dedupe(bot, call):
+    from db import remove_duplicate_stock
+    removed = remove_duplicate_stock()
+    log_event(bot, "stock", f"Admin {call.from_user.id} removed {removed} duplicate stock item(s).")
+    bot.answer_callback_query(call.id, f"{removed} duplicate item(s) removed.", show_alert=True)
+
+@callbacks.route("admin_stock_detail_<platform_name>", guard=require_admin)
 def handle_admin_stock_detail(bot, call, platform_name):
-    conn = __import__('db').get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM platforms WHERE platform_name = ?", (platform_name,))
-    platform = c.fetchone()
-    c.close()
-    conn.close()
+    platform = get_platform(platform_name)
     if not platform:
         bot.send_message(call.message.chat.id, "Platform not found.")
         return
-    platform = dict(platform)  # Convert row to dictionary
-    stock = json.loads(platform["stock"] or "[]")
     price = platform["price"]
     p_type = platform.get("platform_type", "account")
     stock_type = "Cookie file" if p_type == "cookie" else "Login pass"
     text = (f"Platform Name: {platform_name}\n"
             f"Type: {p_type}\n"
             f"Stock Type: {stock_type}\n"
-            f"Accounts Available: {len(stock)}\n"
+            f"Accounts Available: {platform['stock_count']}\n"
             f"Price: {price} pts")
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(types.InlineKeyboardButton("➕ Add Stock", callback_data=f"admin_stock_add_{platform_name}"))
@@ -295,18 +405,12 @@ def handle_admin_stock_detail(bot, call, platform_name):
                           reply_markup=markup)
 
 
+@callbacks.route("admin_stock_add_<platform_name>", guard=require_admin)
 def handle_admin_stock_add(bot, call, platform_name):
-    conn = __import__('db').get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM platforms WHERE platform_name = ?", (platform_name,))
-    platform = c.fetchone()
-    c.close()
-    conn.close()
+    platform = get_platform(platform_name)
     if not platform:
         bot.send_message(call.message.chat.id, "Platform not found.")
         return
-    platform = dict(platform)  # Convert sqlite3.Row to dictionary
     p_type = platform.get("platform_type", "account")
     if p_type == "account":
         msg = bot.send_message(call.message.chat.id, f"Please send the stock text for account platform '{platform_name}':")
@@ -316,30 +420,77 @@ def handle_admin_stock_add(bot, call, platform_name):
         bot.register_next_step_handler(msg, lambda m: process_stock_upload_admin(bot, m, platform_name, p_type))
 
 
+def _open_document_lines(bot, file_id):
+    """
+    Start streaming a Telegram document and return an iterator over its raw
+    (bytes) lines. Only one network chunk is held in memory at a time.
+    """
+    file_info = bot.get_file(file_id)
+    url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(bot.token, file_info.file_path)
+    response = requests.get(url, stream=True, timeout=60)
+    if response.status_code != 200:
+        response.close()
+        raise RuntimeError(f"download failed with HTTP {response.status_code}")
+
+    def lines():
+        with response:
+            yield from response.iter_lines(chunk_size=64 * 1024)
+    return lines()
+
+def _normalize_stock_line(raw):
+    """Decode and clean one uploaded line; returns '' for blank lines and None for invalid ones."""
+    if isinstance(raw, bytes):
+        try:
+            raw = raw.decode("utf-8")
+        except UnicodeDecodeError:
+            raw = raw.decode("latin-1", errors="replace")
+    line = raw.strip().lstrip("\ufeff")
+    if len(line) > config.STOCK_MAX_LINE_LENGTH or "\x00" in line:
+        return None
+    return line
+
+def ingest_stock_lines(platform_name, raw_lines, batch_size=None):
+    """
+    Normalize lines one at a time and insert them in fixed-size batches, each
+    in its own transaction, so memory stays bounded by the batch size.
+    Blank lines are ignored. Returns (added, duplicates, invalid, seen).
+    """
+    from db import add_stock_items
+    batch_size = batch_size or config.STOCK_INGEST_BATCH
+    added = duplicates = invalid = seen = 0
+    batch = []
+    for raw in raw_lines:
+        line = _normalize_stock_line(raw)
+        if line == "":
+            continue
+        seen += 1
+        if line is None:
+            invalid += 1
+            continue
+        batch.append(line)
+        if len(batch) >= batch_size:
+            new, dup = add_stock_items(platform_name, batch)
+            added += new
+            duplicates += dup
+            batch = []
+    if batch:
+        new, dup = add_stock_items(platform_name, batch)
+        added += new
+        duplicates += dup
+    return added, duplicates, invalid, seen
+
 def process_stock_upload_admin(bot, message, platform_name, platform_type, retries=3):
     """
     For 'account' type:
-      - We parse each line in the file as one account (unchanged).
+      - We stream the file and store each line as one account, in batches.
     For 'cookie' type:
       - We store each .txt file as a single item (no line splitting).
       - If it's a ZIP, we only parse .txt files, each one is 1 item in stock.
-    Merges new items with existing stock.
+    New items are appended to the platform's rows in stock_items.
     """
     import io
-    import json
     from zipfile import ZipFile, BadZipFile
-    from db import update_stock_for_platform, get_connection
-
-    # 1) Fetch existing stock from DB so we can merge instead of overwrite
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT stock FROM platforms WHERE platform_name = ?", (platform_name,))
-    row = c.fetchone()
-    c.close()
-    conn.close()
-
-    current_stock = json.loads(row["stock"]) if row and row["stock"] else []
+    from db import add_stock_items, get_stock_count
 
     # We'll store newly parsed items in new_stock
     new_stock = []
@@ -348,20 +499,15 @@ def process_stock_upload_admin(bot, message, platform_name, platform_type, retri
     # ACCOUNT LOGIC
     # -----------------------------------------------------------
     if platform_type == "account":
-        # If it's a document, read the file
+        started = time.monotonic()
         if message.content_type == "document":
+            # Stream the file instead of downloading it whole.
             for attempt in range(retries):
                 try:
-                    file_info = bot.get_file(message.document.file_id)
-                    downloaded_file = bot.download_file(file_info.file_path)
-                    try:
-                        data = downloaded_file.decode('utf-8')
-                    except UnicodeDecodeError:
-                        data = downloaded_file.decode('latin-1', errors='replace')
+                    raw_lines = _open_document_lines(bot, message.document.file_id)
                     break
                 except Exception as e:
                     if attempt < retries - 1:
-                        import time
                         time.sleep(2)
                         continue
                     else:
@@ -369,16 +515,22 @@ def process_stock_upload_admin(bot, message, platform_name, platform_type, retri
                         return
         else:
             # Otherwise assume user typed lines in text
-            data = message.text.strip()
+            raw_lines = (message.text or "").splitlines()
 
-        lines = [line.strip() for line in data.splitlines() if line.strip()]
-        current_stock.extend(lines)  # Merge new lines with existing
-        update_stock_for_platform(platform_name, current_stock)
+        try:
+            added, duplicates, invalid, seen = ingest_stock_lines(platform_name, raw_lines)
+        except Exception as e:
+            bot.send_message(message.chat.id, f"Error while importing stock: {e}")
+            return
+        elapsed = max(time.monotonic() - started, 1e-6)
+        log_event(bot, "stock", f"Platform '{platform_name}' stock: {added} items added.")
 
         bot.send_message(
             message.chat.id,
             f"Stock for '{platform_name}' updated. "
-            f"{len(lines)} new items added. Total stock: {len(current_stock)}"
+            f"{added} new / {duplicates} duplicates skipped, {invalid} invalid line(s) skipped. "
+            f"Total stock: {get_stock_count(platform_name)}\n"
+            f"Processed {seen} non-empty lines in {elapsed:.1f}s ({seen / elapsed:,.0f} lines/sec)."
         )
         send_admin_menu(bot, message)
         return
@@ -424,13 +576,12 @@ def process_stock_upload_admin(bot, message, platform_name, platform_type, retri
             bot.send_message(message.chat.id, "Unsupported file type. Please send a TXT or ZIP file.")
             return
 
-        # Merge new cookie items with existing stock
-        current_stock.extend(new_stock)
-        update_stock_for_platform(platform_name, current_stock)
+        added, duplicates = add_stock_items(platform_name, new_stock)
+        log_event(bot, "stock", f"Platform '{platform_name}' stock: {added} cookie file(s) added.")
 
         bot.send_message(
             message.chat.id,
-            f"Cookie stock updated. {len(new_stock)} new file(s) added. Total stock: {len(current_stock)}"
+            f"Cookie stock updated. {added} new / {duplicates} duplicates skipped. Total stock: {get_stock_count(platform_name)}"
         )
         send_admin_menu(bot, message)
         return
@@ -443,33 +594,19 @@ def process_stock_upload_admin(bot, message, platform_name, platform_type, retri
 # ----------------- CHANNEL MANAGEMENT -----------------
 
 def add_channel(channel_link):
-    conn = __import__('db').get_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO channels (channel_link) VALUES (?)", (channel_link,))
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "channel", f"Channel '{channel_link}' added.")
+    with transaction() as conn:
+        conn.execute("INSERT INTO channels (channel_link) VALUES (?)", (channel_link,))
+    log_event(None, "channel", f"Channel '{channel_link}' added.")
 
 def remove_channel(channel_id):
-    conn = __import__('db').get_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
-    conn.commit()
-    c.close()
-    conn.close()
-    log_event(telebot.TeleBot(config.TOKEN), "channel", f"Channel with ID '{channel_id}' removed.")
+    with transaction() as conn:
+        conn.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
+    log_event(None, "channel", f"Channel with ID '{channel_id}' removed.")
 
 def get_channels():
-    conn = __import__('db').get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM channels")
-    channels = c.fetchall()
-    c.close()
-    conn.close()
-    return [dict(ch) for ch in channels]
+    return [dict(ch) for ch in get_connection().execute("SELECT * FROM channels")]
 
+@callbacks.route("admin_channel", guard=require_admin)
 def handle_admin_channel(bot, call):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -480,6 +617,7 @@ def handle_admin_channel(bot, call):
     bot.edit_message_text("Channel Management", chat_id=call.message.chat.id,
                           message_id=call.message.message_id, reply_markup=markup)
 
+@callbacks.route("admin_channel_add", guard=require_admin)
 def handle_admin_channel_add(bot, call):
     msg = bot.send_message(call.message.chat.id, "Please send the channel link to add:")
     bot.register_next_step_handler(msg, lambda m: process_channel_add(bot, m))
@@ -491,6 +629,7 @@ def process_channel_add(bot, message):
     bot.send_message(message.chat.id, response)
     send_admin_menu(bot, message)
 
+@callbacks.route("admin_channel_remove", guard=require_admin)
 def handle_admin_channel_remove(bot, call):
     channels = get_channels()
     if not channels:
@@ -505,6 +644,7 @@ def handle_admin_channel_remove(bot, call):
     bot.edit_message_text("Select a channel to remove:", chat_id=call.message.chat.id,
                           message_id=call.message.message_id, reply_markup=markup)
 
+@callbacks.route("admin_channel_rm_<id:channel_id>", guard=require_admin)
 def handle_admin_channel_rm(bot, call, channel_id):
     remove_channel(channel_id)
     bot.answer_callback_query(call.id, "Channel removed.")
@@ -512,6 +652,7 @@ def handle_admin_channel_rm(bot, call, channel_id):
 
 # ----------------- ADMIN MANAGEMENT (User/Admin Lists) -----------------
 
+@callbacks.route("admin_manage", guard=require_admin)
 def handle_admin_manage(bot, call):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -526,6 +667,7 @@ def handle_admin_manage(bot, call):
     bot.edit_message_text("Admin Management", chat_id=call.message.chat.id,
                           message_id=call.message.message_id, reply_markup=markup)
 
+@callbacks.route("admin_list", guard=require_admin)
 def handle_admin_list(bot, call):
     admins = get_admins()
     if not admins:
@@ -537,49 +679,40 @@ def handle_admin_list(bot, call):
     bot.edit_message_text(text, chat_id=call.message.chat.id,
                           message_id=call.message.message_id)
 
+@callbacks.route("admin_ban_unban", guard=require_admin)
 def handle_admin_ban_unban(bot, call):
     msg = bot.send_message(call.message.chat.id, "Please send the admin UserID to ban/unban:")
     bot.register_next_step_handler(msg, lambda m: process_admin_ban_unban(bot, m))
 
 def process_admin_ban_unban(bot, message):
     user_id = message.text.strip()
-    from db import get_connection
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM admins WHERE user_id = ?", (user_id,))
-    admin_doc = c.fetchone()
+    admin_doc = get_connection().execute("SELECT * FROM admins WHERE user_id = ?", (user_id,)).fetchone()
     if not admin_doc:
         response = "Admin not found."
     else:
-        if admin_doc["banned"]:
-            unban_user(user_id)
-            response = f"Admin {user_id} has been unbanned."
-        else:
-            ban_user(user_id)
-            response = f"Admin {user_id} has been banned."
-    c.close()
-    conn.close()
+        banned = 0 if admin_doc["banned"] else 1
+        with transaction() as conn:
+            conn.execute("UPDATE admins SET banned = ? WHERE user_id = ?", (banned, user_id))
+        invalidate_admin_cache()
+        response = f"Admin {user_id} has been {'banned' if banned else 'unbanned'}."
     bot.send_message(message.chat.id, response)
     send_admin_menu(bot, message)
 
+@callbacks.route("admin_remove", guard=require_admin)
 def handle_admin_remove(bot, call):
     msg = bot.send_message(call.message.chat.id, "Please send the admin UserID to remove:")
     bot.register_next_step_handler(msg, lambda m: process_admin_remove(bot, m))
 
 def process_admin_remove(bot, message):
     user_id = message.text.strip()
-    from db import get_connection
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-    conn.commit()
-    c.close()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+    invalidate_admin_cache()
     response = f"Admin {user_id} removed."
     bot.send_message(message.chat.id, response)
     send_admin_menu(bot, message)
 
+@callbacks.route("admin_add", guard=require_admin)
 def handle_admin_add(bot, call):
     msg = bot.send_message(call.message.chat.id, "Please send the UserID and Username (separated by space) to add as admin:")
     bot.register_next_step_handler(msg, lambda m: process_admin_add(bot, m))
@@ -590,17 +723,12 @@ def process_admin_add(bot, message):
         response = "Please provide both UserID and Username."
     else:
         user_id, username = parts[0], " ".join(parts[1:])
-        from db import get_connection
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("REPLACE INTO admins (user_id, username, role, banned) VALUES (?, ?, ?, 0)", (user_id, username, "admin"))
-        conn.commit()
-        c.close()
-        conn.close()
-        log_event(telebot.TeleBot(config.TOKEN), "admin", f"Admin '{user_id}' ({username}) added with role 'admin'.")
+        with transaction() as conn:
+            conn.execute("REPLACE INTO admins (user_id, username, role, banned) VALUES (?, ?, ?, 0)", (user_id, username, "admin"))
+        invalidate_admin_cache()
+        log_event(None, "admin", f"Admin '{user_id}' ({username}) added with role 'admin'.")
         try:
-            bot_instance = telebot.TeleBot(config.TOKEN)
-            bot_instance.send_message(user_id, f"Congratulations, you have been added as an admin.")
+            bot.send_message(user_id, f"Congratulations, you have been added as an admin.")
         except Exception as e:
             print(f"Error notifying new admin {user_id}: {e}")
         response = f"Admin {user_id} added with username {username}."
@@ -609,34 +737,89 @@ def process_admin_add(bot, message):
 
 # ----------------- USER MANAGEMENT (Admin Panel) -----------------
 
-def handle_user_management(bot, call):
-    from db import get_connection
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users")
-    # Convert each row to a dictionary so .get() works
-    users = [dict(u) for u in c.fetchall()]
-    c.close()
-    conn.close()
-    if not users:
+USERS_PER_PAGE = 10
+USER_SORT_LABELS = {"join": "newest first", "points": "most points first"}
+
+def _user_button(u):
+    status = "Banned" if u.get("banned", 0) else "Active"
+    btn_text = f"{u.get('username')} ({u.get('telegram_id')}) - {status}"
+    return types.InlineKeyboardButton(btn_text, callback_data=f"admin_user_{u.get('telegram_id')}")
+
+def _user_cursor(u):
+    return f"{u['sort_key']}_{u['telegram_id']}"
+
+@callbacks.route("admin_users", guard=require_admin)
+def handle_user_management(bot, call, sort="join", cursor=None, backwards=False):
+    """
+    Show one keyset page of users. Navigation buttons carry the cursor of the
+    first/last row shown as admin_users_page_<sort>_<n|p>_<value>_<id>.
+    """
+    rows, has_more = get_users_page(sort, cursor, backwards, USERS_PER_PAGE)
+    if not rows and cursor is None:
         bot.answer_callback_query(call.id, "No users found.")
         return
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    for u in users:
-        uid = u.get("telegram_id")
-        username = u.get("username")
-        banned = u.get("banned", 0)
-        status = "Banned" if banned else "Active"
-        btn_text = f"{username} ({uid}) - {status}"
-        callback_data = f"admin_user_{uid}"
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_data))
+    has_next = has_more if not backwards else True
+    has_prev = has_more if backwards else cursor is not None
+    if not rows:
+        # Stepped past either end; start over from the first page.
+        rows, has_next = get_users_page(sort, None, False, USERS_PER_PAGE)
+        has_prev = False
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for u in rows:
+        markup.add(_user_button(u))
+    nav = []
+    if has_prev:
+        nav.append(types.InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_users_page_{sort}_p_{_user_cursor(rows[0])}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"admin_users_page_{sort}_n_{_user_cursor(rows[-1])}"))
+    if nav:
+        markup.row(*nav)
+    other_sort = "points" if sort == "join" else "join"
+    markup.row(
+        types.InlineKeyboardButton(f"↕️ Sort: {USER_SORT_LABELS[other_sort]}", callback_data=f"admin_users_page_{other_sort}"),
+        types.InlineKeyboardButton("🔍 Search", callback_data="admin_users_search"),
+    )
     markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="back_main"))
-    bot.edit_message_text("User Management\nSelect a user to manage:", 
+    bot.edit_message_text(f"User Management ({USER_SORT_LABELS[sort]})\nSelect a user to manage:", 
                             chat_id=call.message.chat.id,
                             message_id=call.message.message_id,
                             reply_markup=markup)
 
+@callbacks.route("admin_users_page_<payload>", guard=require_admin)
+def handle_user_page_callback(bot, call, payload):
+    """Parse '<sort>[_<n|p>_<value>_<id>]' from a pagination button."""
+    parts = payload.split("_", 3)
+    sort = parts[0] if parts[0] in USER_SORT_LABELS else "join"
+    if len(parts) < 4:
+        handle_user_management(bot, call, sort)
+        return
+    value = parts[2]
+    if sort == "points":
+        try:
+            value = int(value)
+        except ValueError:
+            handle_user_management(bot, call, sort)
+            return
+    handle_user_management(bot, call, sort, (value, parts[3]), backwards=parts[1] == "p")
+
+@callbacks.route("admin_users_search", guard=require_admin)
+def handle_user_search(bot, call):
+    msg = bot.send_message(call.message.chat.id, "Send a user ID or username prefix to search for:")
+    bot.register_next_step_handler(msg, lambda m: process_user_search(bot, m))
+
+def process_user_search(bot, message):
+    query = (message.text or "").strip()
+    results = search_users(query, USERS_PER_PAGE)
+    if not results:
+        bot.send_message(message.chat.id, f"No users matching '{query}'.")
+        return
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for u in results:
+        markup.add(_user_button(u))
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_users"))
+    bot.send_message(message.chat.id, f"Users matching '{query}':", reply_markup=markup)
+
+@callbacks.route("admin_user_<id:user_id>", guard=require_admin)
 def handle_user_management_detail(bot, call, user_id):
     user = get_user(user_id)  # get_user returns a dictionary
     if not user:
@@ -664,6 +847,7 @@ def handle_user_management_detail(bot, call, user_id):
     except Exception as e:
         bot.send_message(call.message.chat.id, text, reply_markup=markup)
 
+@callbacks.route("admin_user_<id:user_id>_<action>", guard=require_admin)
 def handle_user_ban_action(bot, call, user_id, action):
     if action == "ban":
         ban_user(user_id)
@@ -678,99 +862,101 @@ def handle_user_ban_action(bot, call, user_id, action):
     bot.answer_callback_query(call.id, result_text)
     handle_user_management_detail(bot, call, user_id)
 
-# ----------------- ADMIN CALLBACK HANDLER -----------------
-
-def admin_callback_handler(bot, call):
-    data = call.data
-    if not (str(call.from_user.id) in config.OWNERS or is_admin(call.from_user)):
-        bot.answer_callback_query(call.id, "Access prohibited.")
-        return
-    if data == "admin_platform":
-        handle_admin_platform(bot, call)
-    elif data == "admin_platform_add":
-        handle_admin_platform_add(bot, call)
-    elif data == "admin_platform_add_account":
-        msg = bot.send_message(call.message.chat.id, "Please send the account platform name:")
-        bot.register_next_step_handler(msg, lambda m: process_account_platform_name(bot, m))
-    elif data == "admin_platform_add_cookie":
-        msg = bot.send_message(call.message.chat.id, "Please send the cookie platform name:")
-        bot.register_next_step_handler(msg, lambda m: process_cookie_platform_name(bot, m))
-    elif data == "admin_platform_remove":
-        platforms = get_platforms()
-        if not platforms:
-            bot.answer_callback_query(call.id, "No platforms to remove.")
-            return
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        for plat in platforms:
-            plat_name = plat.get("platform_name")
-            markup.add(types.InlineKeyboardButton(plat_name, callback_data=f"admin_platform_rm_{plat_name}"))
-        markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_platform"))
-        bot.edit_message_text("Select a platform to remove:", chat_id=call.message.chat.id,
-                              message_id=call.message.message_id, reply_markup=markup)
-    elif data.startswith("admin_platform_rm_"):
-        platform_name = data.split("admin_platform_rm_")[1]
-        remove_platform(platform_name)
-        bot.answer_callback_query(call.id, f"Platform '{platform_name}' removed.")
-        handle_admin_platform(bot, call)
-    elif data == "admin_platform_rename":
-        handle_admin_platform_rename(bot, call)
-    elif data.startswith("admin_platform_rename_"):
-        old_name = data.split("admin_platform_rename_")[1]
-        msg = bot.send_message(call.message.chat.id, f"Send new name for platform '{old_name}':")
-        bot.register_next_step_handler(msg, lambda m: process_platform_rename(bot, m, old_name))
-    elif data == "admin_platform_change_price":
-        handle_admin_platform_change_price(bot, call)
-    elif data.startswith("admin_platform_change_price_"):
-        platform_name = data.split("admin_platform_change_price_")[1]
-        msg = bot.send_message(call.message.chat.id, f"Send new price for platform '{platform_name}':")
-        bot.register_next_step_handler(msg, lambda m: process_platform_change_price(bot, m, platform_name))
-    elif data == "admin_platform_list":
-        handle_admin_platform_list(bot, call)
-    elif data == "admin_stock":
-        handle_admin_stock(bot, call)
-    elif data.startswith("admin_stock_detail_"):
-        platform_name = data.split("admin_stock_detail_")[1]
-        handle_admin_stock_detail(bot, call, platform_name)
-    elif data.startswith("admin_stock_add_"):
-        platform_name = data.split("admin_stock_add_")[1]
-        handle_admin_stock_add(bot, call, platform_name)
-    elif data == "admin_channel":
-        handle_admin_channel(bot, call)
-    elif data == "admin_channel_add":
-        handle_admin_channel_add(bot, call)
-    elif data == "admin_channel_remove":
-        handle_admin_channel_remove(bot, call)
-    elif data.startswith("admin_channel_rm_"):
-        channel_id = data.split("admin_channel_rm_")[1]
-        handle_admin_channel_rm(bot, call, channel_id)
-    elif data == "admin_manage":
-        handle_admin_manage(bot, call)
-    elif data == "admin_list":
-        handle_admin_list(bot, call)
-    elif data == "admin_ban_unban":
-        handle_admin_ban_unban(bot, call)
-    elif data == "admin_remove":
-        handle_admin_remove(bot, call)
-    elif data == "admin_add":
-        handle_admin_add(bot, call)
-    elif data == "admin_users":
-        handle_user_management(bot, call)
-    elif data.startswith("admin_user_") and data.count("_") == 2:
-        user_id = data.split("_")[2]
-        handle_user_management_detail(bot, call, user_id)
-    elif data.startswith("admin_user_") and data.count("_") == 3:
-        parts = data.split("_")
-        user_id = parts[2]
-        action = parts[3]
-        handle_user_ban_action(bot, call, user_id, action)
-    elif data == "back_main":
-        from handlers.main_menu import send_main_menu
-        send_main_menu(bot, call)
-    else:
-        bot.answer_callback_query(call.id, "Unknown admin command.")
-
 # ----------------- SEND ADMIN MENU -----------------
 
+@callbacks.route("admin_dashboard", guard=require_admin)
+def handle_dashboard(bot, call):
+    """Current totals plus the last week of daily snapshots with day-over-day changes."""
+    total_users, banned_users, total_points = get_admin_dashboard()
+    text = (f"📊 Dashboard\n\n"
+            f"Users: {total_users}\n"
+            f"Banned: {banned_users}\n"
+            f"Points in circulation: {total_points}\n")
+    history = get_dashboard_history(8)
+    if len(history) > 1:
+        text += "\nLast days (users / points):\n"
+        for prev, day in zip(history, history[1:]):
+            text += (f"{day['day']}: {day['total_users']} ({day['total_users'] - prev['total_users']:+d})"
+                     f" / {day['total_points']} ({day['total_points'] - prev['total_points']:+d})\n")
+    stats = outbox.metrics()
+    depth = stats["queue_by_priority"]
+    text += (f"\nOutbox: {stats['queue_depth']} queued "
+             f"({' / '.join(f'{name} {n}' for name, n in depth.items())}), "
+             f"{stats['sent']} sent, {stats['throttled']} rate-limited, "
+             f"avg wait {stats['avg_wait_ms']:.0f} ms\n")
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="menu_admin"))
+    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+
+# ----------------- REFERRAL FARMS -----------------
+
+@callbacks.route("admin_farms", guard=require_owner)
+def handle_referral_farms(bot, call):
+    """Referrers with bursts of sign-ups in the lookback window, biggest first."""
+    suspects = get_referral_bursts()
+    text = (f"🕵️ Referral Farms\n\n"
+            f"Referrers with {config.REFERRAL_BURST_THRESHOLD}+ referrals within "
+            f"{config.REFERRAL_BURST_WINDOW_MINUTES} min in the last {config.REFERRAL_BURST_LOOKBACK_DAYS} days:\n")
+    markup = types.InlineKeyboardMarkup()
+    if not suspects:
+        text += "\nNone found."
+    for s in suspects:
+        markup.add(types.InlineKeyboardButton(
+            f"{s['telegram_id']} — burst {s['burst']}, {s['recent']} recent, {s['downline']} total",
+            callback_data=f"admin_farm_{s['telegram_id']}"))
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="menu_admin"))
+    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+
+@callbacks.route("admin_farm_<id:user_id>", guard=require_owner)
+def handle_referral_farm_detail(bot, call, user_id):
+    """One referrer's upline, downline shape and most recent direct referrals."""
+    size, max_depth, by_depth = get_downline_stats(user_id)
+    upline = get_upline(user_id)
+    user = get_user(user_id) or {}
+    text = (f"🕵️ Referrer {user_id} ({html.escape(str(user.get('username')))})\n"
+            f"Joined: {user.get('join_date')}, status: {'Banned' if user.get('banned') else 'Active'}\n"
+            f"Referred by: {' ← '.join(upline[:5]) if upline else '-'}\n\n"
+            f"Downline: {size} users, {max_depth} levels deep\n")
+    for depth, count in list(by_depth.items())[:5]:
+        text += f"  level {depth}: {count}\n"
+    direct = get_direct_referrals(user_id, limit=15)
+    if direct:
+        text += "\nLatest direct referrals:\n"
+        for row in direct:
+            text += (f"{row['referred_at'] or '?'}  {row['telegram_id']} ({html.escape(str(row['username']))})"
+                     f"{' [banned]' if row['banned'] else ''}\n")
+    markup = types.InlineKeyboardMarkup()
+    if size:
+        markup.add(types.InlineKeyboardButton("🌳 Whole Downline", callback_data=f"admin_farm_{user_id}_down_0"))
+    markup.add(types.InlineKeyboardButton("👤 Manage User", callback_data=f"admin_user_{user_id}"))
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_farms"))
+    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+
+DOWNLINE_PER_PAGE = 20
+
+@callbacks.route("admin_farm_<id:user_id>_down_<int:page>", guard=require_owner)
+def handle_referral_farm_downline(bot, call, user_id, page):
+    """One page of a referrer's whole downline, nearest levels first."""
+    page = max(page, 0)
+    rows = get_downline(user_id, limit=DOWNLINE_PER_PAGE + 1, offset=page * DOWNLINE_PER_PAGE)
+    has_next = len(rows) > DOWNLINE_PER_PAGE
+    text = f"🌳 Downline of {user_id}, page {page + 1}\n\n"
+    if not rows:
+        text += "Nobody here."
+    for row in rows[:DOWNLINE_PER_PAGE]:
+        text += (f"L{row['depth']}  {row['telegram_id']} ({html.escape(str(row['username']))})"
+                 f"{' [banned]' if row['banned'] else ''}\n")
+    markup = types.InlineKeyboardMarkup()
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_farm_{user_id}_down_{page - 1}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"admin_farm_{user_id}_down_{page + 1}"))
+    if nav:
+        markup.row(*nav)
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data=f"admin_farm_{user_id}"))
+    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+
 def send_admin_menu(bot, update):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -779,7 +965,9 @@ def send_admin_menu(bot, update):
         types.InlineKeyboardButton("🔗 Channel Mgmt", callback_data="admin_channel"),
         types.InlineKeyboardButton("👥 Admin Mgmt", callback_data="admin_manage"),
         types.InlineKeyboardButton("👤 User Mgmt", callback_data="admin_users"),
-        types.InlineKeyboardButton("➕ Add Admin", callback_data="admin_add")
+        types.InlineKeyboardButton("➕ Add Admin", callback_data="admin_add"),
+        types.InlineKeyboardButton("📊 Dashboard", callback_data="admin_dashboard"),
+        types.InlineKeyboardButton("🕵️ Referral Farms", callback_data="admin_farms")
     )
     markup.add(types.InlineKeyboardButton("🔙 Main Menu", callback_data="back_main"))
     try:
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+import config
+from db import backup_database, rotate_backups, restore_database, DATABASE
+from handlers.admin import invalidate_admin_cache
+from handlers.logs import log_event
+
+def send_backup(bot, message):
+    """Send a gzipped online-backup snapshot of the database as a document."""
+    fd, path = tempfile.mkstemp(suffix=".db.gz")
+    os.close(fd)
+    try:
+        backup_database(path)
+        with open(path, "rb") as f:
+            bot.send_document(message.chat.id, f,
+                              visible_file_name=f"bot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db.gz")
+    finally:
+        os.remove(path)
+
+def restore_from_message(bot, message):
+    """Download the replied-to document and restore the database from it."""
+    file_info = bot.get_file(message.reply_to_message.document.file_id)
+    fd, path = tempfile.mkstemp(suffix=".upload")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(bot.download_file(file_info.file_path))
+        error = restore_database(path)
+    finally:
+        os.remove(path)
+    if error:
+        bot.reply_to(message, f"❌ Backup rejected: {error}")
+        return
+    invalidate_admin_cache()
+    log_event(bot, "database", "Database restored via /recover.", user=message.from_user)
+    bot.reply_to(message, "✅ Database recovered successfully.")
+
+def _backup_loop():
+    while True:
+        time.sleep(config.BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            # A relative BACKUP_DIR lives next to the database file.
+            directory = os.path.join(os.path.dirname(os.path.abspath(DATABASE)), config.BACKUP_DIR)
+            path = rotate_backups(directory, config.BACKUP_KEEP)
+            print(f"Backup written to {path}")
+        except Exception as e:
+            print(f"Error writing scheduled backup: {e}")
+
+def start_backup_scheduler():
+    """Write a rotated local backup every BACKUP_INTERVAL_HOURS; 0 disables it."""
+    if config.BACKUP_INTERVAL_HOURS <= 0:
+        return None
+    thread = threading.Thread(target=_backup_loop, name="backup-scheduler", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,127 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+import config
+from db import (
+    create_broadcast,
+    get_broadcast,
+    get_running_broadcasts,
+    get_broadcast_recipients,
+    checkpoint_broadcast,
+    finish_broadcast,
+    set_users_blocked,
+    BROADCAST_STATUS_RUNNING,
+    BROADCAST_STATUS_CANCELLED,
+)
+from handlers.admin import require_owner
+from handlers.logs import log_event
+from handlers.outbox import outbox, PRIORITY_BROADCAST
+from handlers.router import callbacks
+
+# Telegram answers 403 for users who blocked the bot or deleted their
+# account, and 400 "chat not found" for ids it no longer knows.
+_UNREACHABLE = ("blocked", "deactivated", "chat not found", "user not found")
+
+_running = {}
+_running_lock = threading.Lock()
+
+def _deliver(bot, broadcast, user_id):
+    """Copy the broadcast message to one user; returns 'sent', 'blocked' or 'failed'."""
+    try:
+        bot.copy_message(user_id, broadcast["from_chat_id"], broadcast["message_id"])
+        return "sent"
+    except ApiTelegramException as e:
+        if e.error_code in (400, 403) and any(reason in e.description.lower() for reason in _UNREACHABLE):
+            return "blocked"
+        return "failed"
+    except Exception:
+        return "failed"
+
+def _progress_text(broadcast):
+    done = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    total = max(broadcast["total"], done)
+    percent = done * 100 // total if total else 100
+    return (f"📣 Broadcast #{broadcast['id']} — {broadcast['status']}\n\n"
+            f"Progress: {done}/{total} ({percent}%)\n"
+            f"✅ Sent: {broadcast['sent']}\n"
+            f"🚫 Blocked/deactivated: {broadcast['blocked']}\n"
+            f"⚠️ Failed: {broadcast['failed']}")
+
+def _update_progress(bot, broadcast):
+    markup = None
+    if broadcast["status"] == BROADCAST_STATUS_RUNNING:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("⛔ Cancel", callback_data=f"broadcast_cancel_{broadcast['id']}"))
+    try:
+        bot.edit_message_text(_progress_text(broadcast), chat_id=broadcast["progress_chat_id"],
+                              message_id=broadcast["progress_message_id"], reply_markup=markup)
+    except Exception as e:
+        # "message is not modified" and friends; progress is in the DB anyway.
+        print(f"Error updating broadcast progress: {e}")
+
+def _run(bot, broadcast_id):
+    """
+    Send batch after batch until the recipients run out or the broadcast is
+    cancelled. The cursor is checkpointed after every batch, so at most one
+    batch is sent twice if the process dies mid-way.
+    """
+    broadcast = get_broadcast(broadcast_id)
+    last_progress = 0.0
+    with ThreadPoolExecutor(max_workers=config.BROADCAST_WORKERS, thread_name_prefix=f"broadcast-{broadcast_id}") as pool:
+        def send(user_id):
+            with outbox.priority(PRIORITY_BROADCAST):
+                return _deliver(bot, broadcast, user_id)
+
+        while broadcast["status"] == BROADCAST_STATUS_RUNNING:
+            batch = get_broadcast_recipients(broadcast["cursor"], config.BROADCAST_BATCH)
+            if not batch:
+                finish_broadcast(broadcast_id)
+                break
+            results = list(pool.map(send, batch))
+            unreachable = [user_id for user_id, result in zip(batch, results) if result == "blocked"]
+            if unreachable:
+                set_users_blocked(unreachable)
+            checkpoint_broadcast(broadcast_id, batch[-1], results.count("sent"), results.count("failed"), len(unreachable))
+            broadcast = get_broadcast(broadcast_id)
+            if time.monotonic() - last_progress >= config.BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                _update_progress(bot, broadcast)
+    broadcast = get_broadcast(broadcast_id)
+    _update_progress(bot, broadcast)
+    log_event(bot, "broadcast", f"Broadcast #{broadcast_id} {broadcast['status']}: "
+                                f"{broadcast['sent']} sent, {broadcast['blocked']} blocked, {broadcast['failed']} failed.")
+    with _running_lock:
+        _running.pop(broadcast_id, None)
+
+def _spawn(bot, broadcast_id):
+    with _running_lock:
+        if broadcast_id in _running:
+            return
+        thread = threading.Thread(target=_run, args=(bot, broadcast_id), name=f"broadcast-{broadcast_id}", daemon=True)
+        _running[broadcast_id] = thread
+    thread.start()
+
+def start_broadcast(bot, message):
+    """/broadcast sent in reply to the message that should go to every user."""
+    source = message.reply_to_message
+    if source is None:
+        bot.reply_to(message, "Reply to the message you want to broadcast with /broadcast.")
+        return
+    progress = bot.send_message(message.chat.id, "📣 Starting broadcast...")
+    broadcast = create_broadcast(str(message.from_user.id), source.chat.id, source.message_id,
+                                 progress.chat.id, progress.message_id)
+    log_event(bot, "broadcast", f"Broadcast #{broadcast['id']} started for {broadcast['total']} users.", user=message.from_user)
+    _update_progress(bot, broadcast)
+    _spawn(bot, broadcast["id"])
+
+def resume_broadcasts(bot):
+    """Pick up broadcasts that were still running when the bot stopped."""
+    for broadcast in get_running_broadcasts():
+        _spawn(bot, broadcast["id"])
+
+@callbacks.route("broadcast_cancel_<int:broadcast_id>", guard=require_owner)
+def handle_broadcast_cancel(bot, call, broadcast_id):
+    finish_broadcast(broadcast_id, BROADCAST_STATUS_CANCELLED)
+    bot.answer_callback_query(call.id, "Broadcast cancelled.")
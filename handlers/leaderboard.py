@@ -0,0 +1,34 @@
+# handlers/leaderboard.py
+import html
+from db import get_leaderboard
+
+MEDALS = ["🥇", "🥈", "🥉"]
+
+def _format_board(rows, column, unit):
+    if not rows:
+        return "┃ No users yet.\n"
+    text = ""
+    for i, row in enumerate(rows):
+        place = MEDALS[i] if i < len(MEDALS) else f"{i + 1}."
+        # Names are user-chosen and the bot sends with parse_mode="HTML".
+        name = html.escape(str(row.get('username') or row.get('telegram_id')))
+        text += f"┃ {place} {name} — {row.get(column)} {unit}\n"
+    return text
+
+def send_leaderboard(bot, message):
+    """
+    Shows the top users by points and by referrals.
+    Both boards come from the cached top-N in db.get_leaderboard().
+    """
+    text = (
+        "╭━━━✦❘༻🏆 LEADERBOARD ༺❘✦━━━╮\n"
+        "┃\n"
+        "┃ 💰 Top Points\n"
+        + _format_board(get_leaderboard(10, by="points"), "points", "pts")
+        + "┃\n"
+        "┃ 🤝 Top Referrers\n"
+        + _format_board(get_leaderboard(10, by="referrals"), "referrals", "refs")
+        + "┃\n"
+        "╰━━━━━━━✦✧✦━━━━━━━╯"
+    )
+    bot.send_message(message.chat.id, text)
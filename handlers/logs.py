@@ -1,9 +1,143 @@
+import atexit
+import html
+import queue
+import threading
+import time
 import config
+from handlers.outbox import outbox, PRIORITY_LOG
+
+# Telegram rejects messages longer than this.
+MAX_MESSAGE_LENGTH = 4096
+
+class LogShipper:
+    """
+    Ships log lines to config.LOGS_CHANNEL from a single background thread.
+
+    Lines are queued without blocking the caller and coalesced into as few
+    messages as the 4096-character limit allows, one batch per flush interval.
+    When the queue is full new lines are dropped and a count of them is sent
+    with the next batch instead.
+    """
+
+    def __init__(self, max_queue=config.LOG_QUEUE_SIZE, flush_interval=config.LOG_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._bot = None
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def bind(self, bot):
+        """Use this bot for sending; the first bot bound wins."""
+        if bot is not None and self._bot is None:
+            self._bot = bot
+
+    def submit(self, line):
+        if self._closed:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def close(self, timeout=10):
+        """Send everything still queued and stop the sender thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                stopping = True
+                lines = []
+            else:
+                lines = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    line = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if line is None:
+                    stopping = True
+                else:
+                    lines.append(line)
+            if stopping:
+                # Drain whatever arrived before the close request.
+                while True:
+                    try:
+                        line = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if line is not None:
+                        lines.append(line)
+            with self._lock:
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                lines.append(f"[LOGS] {dropped} log event(s) dropped, queue was full.")
+            for chunk in _pack(lines):
+                self._send(chunk)
+
+    def _send(self, text):
+        if self._bot is None:
+            import telebot
+            self._bot = telebot.TeleBot(config.TOKEN, parse_mode="HTML")
+        try:
+            with outbox.priority(PRIORITY_LOG):
+                self._bot.send_message(config.LOGS_CHANNEL, text)
+        except Exception as e:
+            print(f"Error sending log event: {e}")
+
+def _pack(lines):
+    """
+    HTML-escape lines and join them into messages no longer than
+    MAX_MESSAGE_LENGTH. The bot sends with parse_mode="HTML", and a stray
+    '<' or '&' in a username would get the whole batch rejected.
+    """
+    chunk = ""
+    for line in lines:
+        line = html.escape(line, quote=False)
+        if len(line) > MAX_MESSAGE_LENGTH:
+            line = line[:MAX_MESSAGE_LENGTH - 1]
+            # Don't cut an entity such as &amp; in half.
+            amp = line.rfind("&", -len("&amp;"))
+            if amp != -1 and ";" not in line[amp:]:
+                line = line[:amp]
+            line += "…"
+        if chunk and len(chunk) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        yield chunk
+
+shipper = LogShipper()
+atexit.register(shipper.close)
 
 def log_event(bot, event_type, message, user=None):
     """
-    Send a log message to the channel defined in config.LOGS_CHANNEL.
+    Queue a log message for the channel defined in config.LOGS_CHANNEL.
     If a user object is provided, include both user ID and username (or first name if username is missing).
+    bot may be None; the shipper then sends with the first bot it was given.
     """
     if user:
         uname = user.username if (hasattr(user, "username") and user.username) else user.first_name
@@ -11,7 +145,5 @@ def log_event(bot, event_type, message, user=None):
         full_message = f"[{event_type.upper()}] {user_info} - {message}"
     else:
         full_message = f"[{event_type.upper()}] {message}"
-    try:
-        bot.send_message(config.LOGS_CHANNEL, full_message)
-    except Exception as e:
-        print(f"Error sending log event: {e}")
+    shipper.bind(bot)
+    shipper.submit(full_message)
@@ -0,0 +1,249 @@
+import bisect
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from telebot import apihelper
+import config
+
+# Priority classes, most urgent first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DELIVERY = 1
+PRIORITY_LOG = 2
+PRIORITY_BROADCAST = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_DELIVERY: "delivery",
+    PRIORITY_LOG: "log",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+# Bot API methods that put a message into a chat and count against the flood
+# limits. Everything else (getUpdates, answerCallbackQuery, getChatMember, ...)
+# is sent straight through.
+THROTTLED_METHODS = frozenset({
+    "sendMessage", "sendDocument", "sendPhoto", "sendVideo", "sendAudio",
+    "sendVoice", "sendAnimation", "sendSticker", "sendMediaGroup",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption",
+    "editMessageReplyMarkup",
+})
+
+class _Bucket:
+    """Token bucket: `rate` tokens per second up to `burst`, optionally paused until a time."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp", "paused_until")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready(self, now):
+        return now >= self.paused_until and self.tokens >= 1
+
+    def wait_time(self, now):
+        """Seconds until this bucket can hand out a token."""
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+def _is_private_chat(chat_id):
+    """User chats have positive ids; groups are negative and channels may be '@name'."""
+    return chat_id is not None and chat_id.isdigit()
+
+class Outbox:
+    """
+    Paces outgoing Bot API calls under Telegram's flood limits.
+
+    Every throttled call takes a token from a global bucket and from its
+    chat's bucket before it is sent. Callers wait in priority order, so an
+    interactive reply overtakes queued log batches and broadcasts, and a
+    chat that is out of tokens does not hold up other chats. Interactive
+    replies and deliveries in private chats skip the chat bucket: the user
+    is waiting for them, and holding a handler thread there stalls every
+    other user.
+
+    A 429 answer pauses that chat for its retry_after and the call is
+    repeated. When the 429 cannot be pinned on one chat (no chat_id, or
+    another chat is already paused) the global bucket is paused as well.
+
+    The caller's thread does the waiting and the HTTP request itself, so a
+    send still returns the Message as before. Installed as telebot's
+    CUSTOM_REQUEST_SENDER, it covers every TeleBot instance in the process.
+    """
+
+    def __init__(self, global_rate=config.OUTBOX_GLOBAL_RATE, chat_rate=config.OUTBOX_CHAT_RATE,
+                 chat_burst=config.OUTBOX_CHAT_BURST, max_retries=config.OUTBOX_MAX_RETRIES):
+        now = time.monotonic()
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = _Bucket(global_rate, global_rate, now)
+        self._chats = {}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._last_prune = now
+        self.sent = 0
+        self.throttled = 0
+        self.failed = 0
+        self.granted = 0
+        self.wait_total = 0.0
+
+    @contextmanager
+    def priority(self, level):
+        """Send with priority `level` from this thread for the duration of the block."""
+        previous = getattr(self._local, "priority", None)
+        self._local.priority = level
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def _current_priority(self, chat_id):
+        level = getattr(self._local, "priority", None)
+        if level is not None:
+            return level
+        if str(chat_id) == str(config.LOGS_CHANNEL):
+            return PRIORITY_LOG
+        return PRIORITY_INTERACTIVE
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = _Bucket(self.chat_rate, self.chat_burst, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _prune(self, now):
+        """Forget chats whose bucket has refilled completely; they behave like new ones."""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        waiting = {ticket[2] for ticket in self._waiting}
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if chat_id not in waiting and bucket.tokens >= bucket.burst and now >= bucket.paused_until:
+                del self._chats[chat_id]
+
+    def acquire(self, chat_id, level):
+        """Block until a send to chat_id at priority `level` may go out."""
+        started = time.monotonic()
+        # Exempt tickets only wait for the global bucket and 429 pauses.
+        exempt = level <= PRIORITY_DELIVERY and _is_private_chat(chat_id)
+        ticket = (level, next(self._seq), chat_id, exempt)
+        with self._cond:
+            bisect.insort(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._global.refill(now)
+                    timeout = 0.5
+                    if self._global.ready(now):
+                        # The most urgent waiter whose chat has a token goes next.
+                        for waiting in self._waiting:
+                            bucket = self._chat_bucket(waiting[2], now)
+                            if waiting[3] and now >= bucket.paused_until:
+                                break
+                            if bucket.ready(now):
+                                break
+                            timeout = min(timeout, bucket.wait_time(now))
+                        else:
+                            waiting = None
+                        if waiting == ticket:
+                            self._global.tokens -= 1
+                            if not exempt:
+                                bucket.tokens -= 1
+                            break
+                        if waiting is not None:
+                            # Someone else is eligible; they are woken below.
+                            self._cond.notify_all()
+                    else:
+                        timeout = min(timeout, self._global.wait_time(now))
+                    self._cond.wait(max(timeout, 0.001))
+            finally:
+                self._waiting.remove(ticket)
+            self._prune(now)
+            self.granted += 1
+            self.wait_total += now - started
+            self._cond.notify_all()
+
+    def pause_chat(self, chat_id, seconds):
+        """
+        Hold back every send to chat_id for `seconds` (Telegram's retry_after),
+        and every send at all if the 429 looks like a bot-wide flood limit.
+        """
+        with self._cond:
+            now = time.monotonic()
+            # Another chat already paused means the limit is not this chat's.
+            flood = chat_id is None or any(
+                other != chat_id and bucket.paused_until > now for other, bucket in self._chats.items())
+            bucket = self._chat_bucket(chat_id, now)
+            bucket.paused_until = max(bucket.paused_until, now + seconds)
+            bucket.tokens = 0
+            if flood:
+                self._global.paused_until = max(self._global.paused_until, now + seconds)
+            self.throttled += 1
+            self._cond.notify_all()
+
+    def request(self, method, url, params=None, files=None, **kwargs):
+        """apihelper.CUSTOM_REQUEST_SENDER: pace throttled methods and retry on 429."""
+        session = apihelper._get_req_session()
+        if url.rsplit("/", 1)[-1] not in THROTTLED_METHODS:
+            return session.request(method, url, params=params, files=files, **kwargs)
+        chat_id = (params or {}).get("chat_id")
+        chat_id = str(chat_id) if chat_id is not None else None
+        level = self._current_priority(chat_id)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(chat_id, level)
+            result = session.request(method, url, params=params, files=files, **kwargs)
+            if result.status_code != 429 or attempt == self.max_retries:
+                break
+            try:
+                retry_after = result.json().get("parameters", {}).get("retry_after", 1)
+            except ValueError:
+                retry_after = 1
+            self.pause_chat(chat_id, retry_after)
+            _rewind(files)
+        with self._cond:
+            if result.status_code == 429:
+                self.failed += 1
+            else:
+                self.sent += 1
+        return result
+
+    def install(self):
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    def metrics(self):
+        """Queue depth per priority class, counters and mean wait for a token."""
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for level, _, _, _ in self._waiting:
+                depth[PRIORITY_NAMES[level]] += 1
+            return {
+                "queue_depth": len(self._waiting),
+                "queue_by_priority": depth,
+                "sent": self.sent,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "paused_chats": sum(1 for b in self._chats.values() if b.paused_until > time.monotonic()),
+                "global_paused": self._global.paused_until > time.monotonic(),
+                "avg_wait_ms": self.wait_total / self.granted * 1000 if self.granted else 0.0,
+            }
+
+def _rewind(files):
+    """Seek uploaded files back to the start so a retried request sends them again."""
+    for value in (files or {}).values():
+        f = value[1] if isinstance(value, tuple) else value
+        if hasattr(f, "seek"):
+            f.seek(0)
+
+outbox = Outbox()
@@ -1,6 +1,6 @@
 import telebot
 import config
-from db import get_user, clear_pending_referral, add_referral, update_user_verified
+from db import get_user, clear_pending_referral, add_referral, update_user_verified, referral_burst_size
 from handlers.logs import log_event
 
 def extract_referral_code(message):
@@ -29,6 +29,11 @@ def process_verified_referral(telegram_id, bot_instance):
         except Exception as e:
             print(f"Error notifying referrer: {e}")
         log_event(bot_instance, "referral", f"User {referrer_id} referred user {user.get('telegram_id')}.")
+        burst = referral_burst_size(referrer_id)
+        if burst >= config.REFERRAL_BURST_THRESHOLD:
+            log_event(bot_instance, "referral_burst",
+                      f"User {referrer_id} referred {burst} users in the last {config.REFERRAL_BURST_WINDOW_MINUTES} minutes "
+                      f"(possible referral farm, see Admin Panel > Referral Farms).")
 
 def send_referral_menu(bot, message):
     telegram_id = str(message.from_user.id)
@@ -1,8 +1,46 @@
 # handlers/review.py
+import html
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
 import telebot
+from telebot.apihelper import ApiException, ApiTelegramException
 import config
 from db import add_review
 from handlers.logs import log_event
+from handlers.outbox import outbox, PRIORITY_LOG
+
+_fanout = ThreadPoolExecutor(max_workers=config.OWNER_FANOUT_WORKERS, thread_name_prefix="owner-fanout")
+
+def _is_transient(e):
+    """Flood limits, Telegram server errors and network failures may pass on a retry; a 400 or 403 will not."""
+    if isinstance(e, ApiTelegramException):
+        code = e.error_code
+    elif isinstance(e, ApiException):
+        code = e.result.status_code
+    else:
+        return isinstance(e, requests.exceptions.RequestException)
+    return code == 429 or code >= 500
+
+def _deliver(owner, send, kind, attempt=0):
+    """Run send(owner); on a transient failure retry later on a timer, up to len(OWNER_RETRY_DELAYS) times."""
+    try:
+        with outbox.priority(PRIORITY_LOG):
+            send(owner)
+    except Exception as e:
+        if not _is_transient(e) or attempt >= len(config.OWNER_RETRY_DELAYS):
+            print(f"Giving up sending {kind} to owner {owner}: {e}")
+            return
+        print(f"Error sending {kind} to owner {owner} (attempt {attempt + 1}), retrying: {e}")
+        timer = threading.Timer(config.OWNER_RETRY_DELAYS[attempt],
+                                lambda: _fanout.submit(_deliver, owner, send, kind, attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+def notify_owners(send, kind):
+    """Call send(owner_id) for every owner concurrently in the background."""
+    for owner in config.OWNERS:
+        _fanout.submit(_deliver, owner, send, kind)
 
 def prompt_review(bot, message):
     """
@@ -17,14 +55,10 @@ def process_review(bot, message):
     """
     review_text = message.text
     add_review(str(message.from_user.id), review_text)
-    for owner in config.OWNERS:
-        try:
-            bot.send_message(owner,
-                             f"📢 Review from {message.from_user.username or message.from_user.first_name} ({message.from_user.id}):\n\n{review_text}",
-                             parse_mode="Markdown")
-        except Exception as e:
-            print(f"Error sending review to owner {owner}: {e}")
     bot.send_message(message.chat.id, "✅ Thank you for your feedback!", parse_mode="Markdown")
+    name = html.escape(message.from_user.username or message.from_user.first_name or "")
+    text = f"📢 Review from {name} ({message.from_user.id}):\n\n{html.escape(review_text or '')}"
+    notify_owners(lambda owner: bot.send_message(owner, text, parse_mode="HTML"), "review")
     log_event(bot, "review", f"Review received from user {message.from_user.id}.", user=message.from_user)
 
 def process_report(bot, message):
@@ -45,19 +79,19 @@ def process_report(bot, message):
 
     user = message.from_user
     username = user.username if user.username else user.first_name
-    report_header = f"Report from {username} ({user.id}):\n\n"
+    report_header = f"Report from {html.escape(username or '')} ({user.id}):\n\n"
+    report_text = html.escape(report_text)
+
+    def send(owner):
+        if message.content_type == "photo":
+            # Use highest-resolution photo.
+            photo_id = message.photo[-1].file_id
+            bot.send_photo(owner, photo_id, caption=report_header + report_text, parse_mode="HTML")
+        elif message.content_type == "document":
+            bot.send_document(owner, message.document.file_id, caption=report_header + report_text, parse_mode="HTML")
+        else:
+            bot.send_message(owner, report_header + report_text, parse_mode="HTML")
 
-    for owner in config.OWNERS:
-        try:
-            if message.content_type == "photo":
-                # Use highest-resolution photo.
-                photo_id = message.photo[-1].file_id
-                bot.send_photo(owner, photo_id, caption=report_header + report_text, parse_mode="HTML")
-            elif message.content_type == "document":
-                bot.send_document(owner, message.document.file_id, caption=report_header + report_text, parse_mode="HTML")
-            else:
-                bot.send_message(owner, report_header + report_text, parse_mode="HTML")
-        except Exception as e:
-            print(f"Error sending report to owner {owner}: {e}")
     bot.send_message(message.chat.id, "✅ Your report has been submitted. Thank you!")
+    notify_owners(send, "report")
     
@@ -1,25 +1,53 @@
 import telebot
 from telebot import types
-import random
 import config
-import json
-import sqlite3
-from db import get_user, update_user_points, get_account_claim_cost, get_platforms
+from db import (
+    get_account_claim_cost,
+    get_platforms,
+    get_platform,
+    platforms_version,
+    claim_stock,
+    CLAIM_INSUFFICIENT,
+    CLAIM_EMPTY,
+    CLAIM_NOT_FOUND,
+    CLAIM_NO_USER,
+)
 from handlers.logs import log_event
+from handlers.outbox import outbox, PRIORITY_DELIVERY
 
-def send_rewards_menu(bot, message):
+# (platforms_version, markup) of the last rendered rewards keyboard.
+_rewards_markup = (None, None)
+
+def _build_rewards_markup():
+    """
+    Return the rewards keyboard, rebuilding it only when a platform's name,
+    price or stock count changed since it was last rendered.
+    """
+    global _rewards_markup
+    version = platforms_version()
+    cached_version, markup = _rewards_markup
+    if cached_version == version:
+        return markup
     platforms = get_platforms()
     if not platforms:
+        markup = None
+    else:
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        default_price = get_account_claim_cost()
+        for platform in platforms:
+            platform_name = platform.get("platform_name")
+            price = platform.get("price") or default_price
+            btn_text = f"{platform_name} | Stock: {platform.get('stock_count', 0)} | Price: {price} pts"
+            markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"reward_{platform_name}"))
+        markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="back_main"))
+    _rewards_markup = (version, markup)
+    return markup
+
+def send_rewards_menu(bot, message):
+    markup = _build_rewards_markup()
+    if markup is None:
         bot.send_message(message.chat.id, "😢 No platforms available at the moment.")
         return
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    for platform in platforms:
-        platform_name = platform.get("platform_name")
-        stock = json.loads(platform.get("stock") or "[]")
-        price = platform.get("price") or get_account_claim_cost()
-        btn_text = f"{platform_name} | Stock: {len(stock)} | Price: {price} pts"
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"reward_{platform_name}"))
-    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="back_main"))
     try:
         bot.edit_message_text("<b>🎯 Available Platforms 🎯</b>", 
                               chat_id=message.chat.id,
@@ -30,22 +58,14 @@ def send_rewards_menu(bot, message):
                          parse_mode="HTML", reply_markup=markup)
 
 def handle_platform_selection(bot, call, platform_name):
-    conn = __import__('db').get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM platforms WHERE platform_name = ?", (platform_name,))
-    platform = c.fetchone()
-    c.close()
-    conn.close()
+    platform = get_platform(platform_name)
     if not platform:
         bot.send_message(call.message.chat.id, "Platform not found.")
         return
-    # Convert the row to a dictionary
-    platform = dict(platform)
-    stock = json.loads(platform["stock"] or "[]")
+    stock_count = platform["stock_count"]
     price = platform["price"] or get_account_claim_cost()
-    if stock:
-        text = f"<b>{platform_name}</b>:\n✅ Accounts Available: {len(stock)}\nPrice: {price} pts per account"
+    if stock_count:
+        text = f"<b>{platform_name}</b>:\n✅ Accounts Available: {stock_count}\nPrice: {price} pts per account"
         markup = types.InlineKeyboardMarkup(row_width=1)
         markup.add(types.InlineKeyboardButton("🎁 Claim Account", callback_data=f"claim_{platform_name}"))
     else:
@@ -106,40 +126,19 @@ By @shadowsquad0"""
 
 def claim_account(bot, call, platform_name):
     user_id = str(call.from_user.id)
-    user = get_user(user_id)
-    if user is None:
+    result = claim_stock(user_id, platform_name)
+    if result.status == CLAIM_NO_USER:
         bot.send_message(call.message.chat.id, "User not found. Please /start the bot first.")
         return
-    conn = __import__('db').get_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM platforms WHERE platform_name = ?", (platform_name,))
-    platform = c.fetchone()
-    c.close()
-    conn.close()
-    if not platform:
+    if result.status == CLAIM_NOT_FOUND:
         bot.send_message(call.message.chat.id, "Platform not found.")
         return
-    # Convert platform row to dictionary
-    platform = dict(platform)
-    stock = json.loads(platform["stock"] or "[]")
-    price = platform["price"] or get_account_claim_cost()
-    try:
-        current_points = int(user.get("points", 0))
-    except Exception as e:
-        bot.send_message(call.message.chat.id, f"Error reading your points: {e}")
-        return
-    if current_points < price:
-        bot.send_message(call.message.chat.id, f"Insufficient points (each account costs {price} pts). Earn more via referrals or keys.")
-        return
-    if not stock:
+    if result.status == CLAIM_EMPTY:
         bot.send_message(call.message.chat.id, "No accounts available.")
         return
-    index = random.randint(0, len(stock) - 1)
-    account = stock.pop(index)
-    from db import update_stock_for_platform
-    update_stock_for_platform(platform_name, stock)
-    new_points = current_points - price
-    update_user_points(user_id, new_points)
-    log_event(bot, "account_claim", f"User {user_id} claimed an account from {platform_name}. New balance: {new_points} pts.")
-    send_premium_account_info(bot, call.message.chat.id, platform_name, account)
+    if result.status == CLAIM_INSUFFICIENT:
+        bot.send_message(call.message.chat.id, f"Insufficient points (each account costs {result.price} pts). Earn more via referrals or keys.")
+        return
+    log_event(bot, "account_claim", f"User {user_id} claimed an account from {platform_name}. New balance: {result.balance} pts.")
+    with outbox.priority(PRIORITY_DELIVERY):
+        send_premium_account_info(bot, call.message.chat.id, platform_name, result.item)
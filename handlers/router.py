@@ -0,0 +1,124 @@
+# handlers/router.py
+import re
+import threading
+import time
+
+# Placeholder types usable in route patterns: <name>, <int:name>, <id:name>.
+# 'id' matches digits like 'int' but keeps the value a string (Telegram ids are TEXT in the DB).
+CONVERTERS = {
+    "str": (r".+", str),
+    "int": (r"-?\d+", int),
+    "id": (r"-?\d+", str),
+}
+
+_PLACEHOLDER = re.compile(r"<(?:(\w+):)?(\w+)>")
+
+class Route:
+    def __init__(self, pattern, handler, guard=None):
+        self.pattern = pattern
+        self.handler = handler
+        self.guard = guard
+        self.prefix = pattern.split("<", 1)[0]
+        self.converters = {}
+        tail = pattern[len(self.prefix):]
+        regex = ""
+        pos = 0
+        for m in _PLACEHOLDER.finditer(tail):
+            kind = m.group(1) or "str"
+            expr, convert = CONVERTERS[kind]
+            regex += re.escape(tail[pos:m.start()]) + f"(?P<{m.group(2)}>{expr})"
+            self.converters[m.group(2)] = convert
+            pos = m.end()
+        regex += re.escape(tail[pos:])
+        self.regex = re.compile(regex, re.DOTALL) if self.converters else None
+
+    def match(self, data):
+        """Return the converted arguments if data fits this route, else None."""
+        m = self.regex.fullmatch(data, len(self.prefix))
+        if not m:
+            return None
+        return {name: self.converters[name](value) for name, value in m.groupdict().items()}
+
+class CallbackRouter:
+    """
+    Dispatches callback_data to handlers registered with @router.route(pattern).
+
+    Patterns without placeholders are looked up in a dict. Patterns such as
+    'claim_<platform_name>' or 'admin_user_<id:user_id>_<action>' are stored in
+    a prefix trie under their literal prefix. The longest matching prefix
+    wins, so arguments may contain underscores. Handlers are called as
+    handler(bot, call, **arguments).
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self._timing_hooks = []
+        # pattern -> (calls, total seconds); handlers run on several threads.
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def route(self, pattern, guard=None):
+        """
+        Register the decorated function for pattern. guard(bot, call) runs
+        first; when it returns False the handler is skipped.
+        """
+        def decorator(handler):
+            self.add(pattern, handler, guard)
+            return handler
+        return decorator
+
+    def add(self, pattern, handler, guard=None):
+        route = Route(pattern, handler, guard)
+        if route.regex is None:
+            self._exact[pattern] = route
+            return route
+        node = self._trie
+        for ch in route.prefix:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, []).append(route)
+        return route
+
+    def add_timing_hook(self, hook):
+        """Call hook(pattern, seconds) after every dispatched callback."""
+        self._timing_hooks.append(hook)
+
+    def resolve(self, data):
+        """Return (route, arguments) for data, or (None, None)."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, {}
+        candidates = []
+        node = self._trie
+        for ch in data:
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                candidates.append(node[None])
+        for routes in reversed(candidates):
+            for route in routes:
+                args = route.match(data)
+                if args is not None:
+                    return route, args
+        return None, None
+
+    def dispatch(self, bot, call):
+        """Run the handler for call.data. Returns False if no route matched."""
+        route, args = self.resolve(call.data or "")
+        if route is None:
+            return False
+        started = time.perf_counter()
+        try:
+            if route.guard is None or route.guard(bot, call):
+                route.handler(bot, call, **args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                count, total = self.stats.get(route.pattern, (0, 0.0))
+                self.stats[route.pattern] = (count + 1, total + elapsed)
+            for hook in self._timing_hooks:
+                hook(route.pattern, elapsed)
+        return True
+
+callbacks = CallbackRouter()
@@ -1,32 +1,97 @@
 # handlers/verification.py
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import telebot
 from telebot import types
 import config
 from handlers.admin import is_admin
 from handlers.main_menu import send_main_menu
 
-def check_channel_membership(bot, user_id):
+# (user_id, channel) -> (is_member, expires_at), least recently used first,
+# at most MEMBERSHIP_CACHE_SIZE entries.
+_membership_cache = OrderedDict()
+# channel -> (chat_id, bot_is_admin, expires_at)
+_channel_cache = {}
+_bot_id = None
+_cache_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=config.MEMBERSHIP_CHECK_WORKERS, thread_name_prefix="membership")
+
+def _channel_info(bot, channel):
     """
-    Check if a user is a member of all required channels.
+    Resolve a channel link to its chat id and whether the bot administers it.
+    These rarely change, so they are cached for MEMBERSHIP_CACHE_TTL.
     """
-    for channel in config.REQUIRED_CHANNELS:
-        try:
-            # Extract the channel username from the URL.
-            channel_username = channel.rstrip('/').split("/")[-1]
-            chat = bot.get_chat("@" + channel_username)
-            # Ensure the bot is an admin in the channel (needed for reliable membership checking).
-            bot_member = bot.get_chat_member(chat.id, bot.get_me().id)
-            if bot_member.status not in ["administrator", "creator"]:
-                print(f"Bot is not admin in {channel}")
-                return False
-            # Check the user's membership status.
-            user_member = bot.get_chat_member(chat.id, user_id)
-            if user_member.status not in ["member", "creator", "administrator"]:
-                return False
-        except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
+    global _bot_id
+    now = time.monotonic()
+    cached = _channel_cache.get(channel)
+    if cached and cached[2] > now:
+        return cached[0], cached[1]
+    if _bot_id is None:
+        _bot_id = bot.get_me().id
+    # Extract the channel username from the URL.
+    channel_username = channel.rstrip('/').split("/")[-1]
+    chat = bot.get_chat("@" + channel_username)
+    # Ensure the bot is an admin in the channel (needed for reliable membership checking).
+    bot_member = bot.get_chat_member(chat.id, _bot_id)
+    bot_is_admin = bot_member.status in ["administrator", "creator"]
+    _channel_cache[channel] = (chat.id, bot_is_admin, now + config.MEMBERSHIP_CACHE_TTL)
+    return chat.id, bot_is_admin
+
+def _check_channel(bot, user_id, channel):
+    try:
+        chat_id, bot_is_admin = _channel_info(bot, channel)
+        if not bot_is_admin:
+            print(f"Bot is not admin in {channel}")
             return False
-    return True
+        # Check the user's membership status.
+        user_member = bot.get_chat_member(chat_id, user_id)
+        is_member = user_member.status in ["member", "creator", "administrator"]
+    except Exception as e:
+        print(f"Error checking membership for {channel}: {e}")
+        return False
+    ttl = config.MEMBERSHIP_CACHE_TTL if is_member else config.MEMBERSHIP_NEGATIVE_TTL
+    _cache_membership(user_id, channel, is_member, ttl)
+    return is_member
+
+def _cache_membership(user_id, channel, is_member, ttl):
+    """Store a membership answer, dropping expired and least recently used entries."""
+    now = time.monotonic()
+    with _cache_lock:
+        _membership_cache[(user_id, channel)] = (is_member, now + ttl)
+        _membership_cache.move_to_end((user_id, channel))
+        while _membership_cache:
+            key, (_, expires_at) = next(iter(_membership_cache.items()))
+            if expires_at > now and len(_membership_cache) <= config.MEMBERSHIP_CACHE_SIZE:
+                break
+            del _membership_cache[key]
+
+def check_channel_membership(bot, user_id, use_negative=True):
+    """
+    Check if a user is a member of all required channels.
+    Cached answers are used where still fresh; the remaining channels are
+    checked concurrently, so a cold check costs about one round-trip.
+    With use_negative=False cached "not a member" answers are checked again,
+    for when the user says they have just joined.
+    """
+    now = time.monotonic()
+    pending = []
+    with _cache_lock:
+        for channel in config.REQUIRED_CHANNELS:
+            cached = _membership_cache.get((user_id, channel))
+            if cached and cached[1] > now and (cached[0] or use_negative):
+                _membership_cache.move_to_end((user_id, channel))
+                if not cached[0]:
+                    return False
+            else:
+                if cached:
+                    del _membership_cache[(user_id, channel)]
+                pending.append(channel)
+    if not pending:
+        return True
+    futures = [_executor.submit(_check_channel, bot, user_id, channel) for channel in pending]
+    return all(f.result() for f in futures)
 
 def send_verification_message(bot, message):
     """
@@ -57,7 +122,7 @@ def handle_verification_callback(bot, call):
     Handles the callback from the verification button.
     Rechecks channel membership and shows the main menu if verified.
     """
-    if check_channel_membership(bot, call.from_user.id):
+    if check_channel_membership(bot, call.from_user.id, use_negative=False):
         bot.answer_callback_query(call.id, "✅ Verification successful! 🎉")
         send_main_menu(bot, call.message)
     else:
@@ -1,22 +1,35 @@
 import telebot
 import config
+import io
 import os
 from datetime import datetime
-from db import init_db, add_user, get_user, claim_key_in_db, DATABASE
+from db import init_db, add_user, get_user, claim_key_in_db, set_users_blocked
 from handlers.verification import send_verification_message, handle_verification_callback
 from handlers.main_menu import send_main_menu
 from handlers.referral import extract_referral_code, process_verified_referral, send_referral_menu, get_referral_link
 from handlers.rewards import send_rewards_menu, handle_platform_selection, claim_account
 from handlers.review import prompt_review, process_report
 from handlers.account_info import send_account_info
+from handlers.leaderboard import send_leaderboard
+from handlers.broadcast import start_broadcast, resume_broadcasts
+from handlers.backup import send_backup, restore_from_message, start_backup_scheduler
 from handlers.admin import (
-    send_admin_menu, admin_callback_handler, is_admin, lend_points, 
+    send_admin_menu, require_admin, is_admin, lend_points, 
     update_account_claim_cost, update_referral_bonus, 
-    generate_normal_key, generate_premium_key, add_key
+    generate_keys
 )
 from handlers.logs import log_event
+from handlers.router import callbacks
+from handlers.outbox import outbox
 
-bot = telebot.TeleBot(config.TOKEN, parse_mode="HTML")
+if config.BOT_API_URL:
+    telebot.apihelper.API_URL = config.BOT_API_URL
+if config.BOT_FILE_URL:
+    telebot.apihelper.FILE_URL = config.BOT_FILE_URL
+outbox.install()
+
+# In webhook mode the webhook worker pool runs the handlers itself.
+bot = telebot.TeleBot(config.TOKEN, parse_mode="HTML", threaded=not config.USE_WEBHOOK)
 init_db()
 
 def check_if_banned(message):
@@ -42,6 +55,9 @@ def start_command(message):
             pending_referrer=pending_ref
         )
         user = get_user(user_id)
+    elif user.get("blocked"):
+        # They are talking to the bot again, so broadcasts can reach them.
+        set_users_blocked([user_id], blocked=False)
     if user.get("pending_referrer"):
         process_verified_referral(user_id, bot)
     if is_admin(get_user(user_id)):
@@ -69,7 +85,7 @@ def lend_command(message):
         bot.reply_to(message, "Points must be a number.")
         return
     custom_message = " ".join(parts[3:]) if len(parts) > 3 else None
-    result = lend_points(str(message.from_user.id), user_id, points, custom_message)
+    result = lend_points(bot, str(message.from_user.id), user_id, points, custom_message)
     bot.reply_to(message, result)
     log_event(bot, "lend", f"Owner {message.from_user.id} lent {points} pts to user {user_id}.", user=message.from_user)
 
@@ -94,6 +110,12 @@ def report_command(message):
     msg = bot.send_message(message.chat.id, "📝 Please type your report message (you may attach a photo or document):")
     bot.register_next_step_handler(msg, lambda m: process_report(bot, m))
 
+@bot.message_handler(commands=["leaderboard"])
+def leaderboard_command(message):
+    if check_if_banned(message):
+        return
+    send_leaderboard(bot, message)
+
 @bot.message_handler(commands=["tutorial"])
 def tutorial_command(message):
     if check_if_banned(message):
@@ -142,20 +164,26 @@ def gen_command(message):
             bot.reply_to(message, "Points must be a number.")
             return
 
-    generated = []
-    if key_type == "normal":
-        for _ in range(qty):
-            key = generate_normal_key() 
-            add_key(key, "normal", default_points)
-            generated.append(key)
-    elif key_type == "premium":
-        for _ in range(qty):
-            key = generate_premium_key() 
-            add_key(key, "premium", default_points)
-            generated.append(key)
-    else:
+    if key_type not in ("normal", "premium"):
         bot.reply_to(message, "Key type must be either 'normal' or 'premium'.")
         return
+    if not 0 < qty <= config.MAX_GEN_KEYS:
+        bot.reply_to(message, f"Quantity must be between 1 and {config.MAX_GEN_KEYS}.")
+        return
+
+    generated = generate_keys(message.from_user.id, key_type, qty, default_points)
+
+    # Large batches go out as a text file; one message cannot hold them.
+    if len(generated) > config.GEN_INLINE_LIMIT:
+        document = io.BytesIO("\n".join(generated).encode("utf-8"))
+        document.name = f"{key_type}_keys_{len(generated)}.txt"
+        bot.send_document(
+            message.chat.id,
+            document,
+            caption=f"🎁 {len(generated)} {key_type} keys, {default_points} pts each.\nRedeem with /redeem KEY",
+            reply_to_message_id=message.message_id,
+        )
+        return
 
     # Build response
     if generated:
@@ -177,6 +205,13 @@ def gen_command(message):
     bot.reply_to(message, text, parse_mode="HTML")
 
 
+@bot.message_handler(commands=["broadcast"])
+def broadcast_command(message):
+    if str(message.from_user.id) not in config.OWNERS:
+        bot.reply_to(message, "🚫 You are not authorized.")
+        return
+    start_broadcast(bot, message)
+
 # ---------------- New Recovery Commands ----------------
 
 @bot.message_handler(commands=["recover"])
@@ -190,11 +225,7 @@ def recover_command(message):
         bot.reply_to(message, "Please reply to a valid bot database file to recover it.")
         return
     try:
-        file_info = bot.get_file(message.reply_to_message.document.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        with open(DATABASE, "wb") as f:
-            f.write(downloaded_file)
-        bot.reply_to(message, "✅ Database recovered successfully.")
+        restore_from_message(bot, message)
     except Exception as e:
         bot.reply_to(message, f"Error recovering database: {e}")
 
@@ -205,87 +236,117 @@ def get_command(message):
         bot.reply_to(message, "🚫 You are not authorized.")
         return
     try:
-        with open(DATABASE, "rb") as f:
-            bot.send_document(message.chat.id, f)
+        send_backup(bot, message)
     except Exception as e:
         bot.reply_to(message, f"Error sending database file: {e}")
 
 # ---------------- Callback Query Handlers ----------------
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_main")
-def callback_back_main(call):
+@callbacks.route("back_main")
+def callback_back_main(bot, call):
     try:
         bot.delete_message(call.message.chat.id, call.message.message_id)
     except Exception as e:
         print("Error deleting message:", e)
-    from handlers.main_menu import send_main_menu
     send_main_menu(bot, call.message)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("verify"))
-def callback_verify(call):
-    from handlers.verification import handle_verification_callback
+@callbacks.route("verify")
+def callback_verify(bot, call):
     handle_verification_callback(bot, call)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("admin"))
-def callback_admin(call):
-    admin_callback_handler(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("menu_"))
-def callback_menu(call):
-    if call.data == "menu_rewards":
-        send_rewards_menu(bot, call.message)
-    elif call.data == "menu_info":
-        # FIX HERE: pass 'call' instead of 'call.message'
-        from handlers.account_info import send_account_info
-        send_account_info(bot, call)  
-    elif call.data == "menu_referral":
-        from handlers.referral import send_referral_menu
-        send_referral_menu(bot, call.message)
-    elif call.data == "menu_review":
-        from handlers.review import prompt_review
-        prompt_review(bot, call.message)
-    elif call.data == "menu_report":
-        msg = bot.send_message(call.message.chat.id, "📝 Please type your report message (you may attach a photo or document):")
-        bot.register_next_step_handler(msg, lambda m: process_report(bot, m))
-    elif call.data == "menu_support":
-        from handlers.support import send_support_message
-        send_support_message(bot, call.message)
-    elif call.data == "menu_admin":
-        from handlers.admin import send_admin_menu
-        send_admin_menu(bot, call.message)
-    else:
-        bot.answer_callback_query(call.id, "Unknown menu command.")
+@callbacks.route("menu_rewards")
+def callback_menu_rewards(bot, call):
+    send_rewards_menu(bot, call.message)
+
+@callbacks.route("menu_info")
+def callback_menu_info(bot, call):
+    # Pass 'call' instead of 'call.message'
+    send_account_info(bot, call)
 
-@bot.callback_query_handler(func=lambda call: call.data == "get_ref_link")
-def callback_get_ref_link(call):
-    from handlers.referral import get_referral_link
+@callbacks.route("menu_referral")
+def callback_menu_referral(bot, call):
+    send_referral_menu(bot, call.message)
+
+@callbacks.route("menu_review")
+def callback_menu_review(bot, call):
+    prompt_review(bot, call.message)
+
+@callbacks.route("menu_report")
+def callback_menu_report(bot, call):
+    msg = bot.send_message(call.message.chat.id, "📝 Please type your report message (you may attach a photo or document):")
+    bot.register_next_step_handler(msg, lambda m: process_report(bot, m))
+
+@callbacks.route("menu_support")
+def callback_menu_support(bot, call):
+    from handlers.support import send_support_message
+    send_support_message(bot, call.message)
+
+@callbacks.route("menu_admin", guard=require_admin)
+def callback_menu_admin(bot, call):
+    send_admin_menu(bot, call.message)
+
+@callbacks.route("get_ref_link")
+def callback_get_ref_link(bot, call):
     referral_link = get_referral_link(str(call.from_user.id))
     bot.answer_callback_query(call.id, "Referral link generated!")
     bot.send_message(call.message.chat.id, f"Your referral link:\n{referral_link}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("reward_"))
-def callback_reward(call):
-    platform_name = call.data.split("reward_")[1]
-    from handlers.rewards import handle_platform_selection
+@callbacks.route("reward_<platform_name>")
+def callback_reward(bot, call, platform_name):
     handle_platform_selection(bot, call, platform_name)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("claim_"))
-def callback_claim(call):
-    platform_name = call.data.split("claim_")[1]
-    from handlers.rewards import claim_account
+@callbacks.route("claim_<platform_name>")
+def callback_claim(bot, call, platform_name):
     claim_account(bot, call, platform_name)
 
-# ---------------- Polling Loop ----------------
+@bot.callback_query_handler(func=lambda call: True)
+def callback_dispatch(call):
+    if not callbacks.dispatch(bot, call):
+        bot.answer_callback_query(call.id, "Unknown command.")
 
-while True:
-    try:
-        bot.polling(none_stop=True)
-    except Exception as e:
-        print(f"Polling error: {e}")
+# ---------------- Update Ingress ----------------
+
+def run_polling():
+    while True:
         try:
-            bot.send_message(config.LOGS_CHANNEL, f"Polling error: {e}")
-        except Exception:
-            pass
-        import time
-        time.sleep(15)
-            
+            bot.polling(none_stop=True)
+        except Exception as e:
+            print(f"Polling error: {e}")
+            try:
+                bot.send_message(config.LOGS_CHANNEL, f"Polling error: {e}")
+            except Exception:
+                pass
+            import time
+            time.sleep(15)
+
+def run_webhook():
+    from webhook import WebhookServer
+    server = WebhookServer(
+        bot,
+        config.WEBHOOK_LISTEN,
+        config.WEBHOOK_PORT,
+        config.WEBHOOK_PATH,
+        secret=config.WEBHOOK_SECRET,
+        workers=config.WEBHOOK_WORKERS,
+        queue_size=config.WEBHOOK_QUEUE_SIZE,
+    )
+    server.start()
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+        secret_token=server.secret,
+        max_connections=100,
+    )
+    print(f"Webhook server listening on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+    try:
+        server.wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    resume_broadcasts(bot)
+    start_backup_scheduler()
+    if config.USE_WEBHOOK:
+        run_webhook()
+    else:
+        run_polling()
@@ -0,0 +1,165 @@
+import hmac
+import json
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot import types
+
+# Latency samples kept for the percentile metrics.
+LATENCY_SAMPLES = 10000
+
+def _update_key(data):
+    """
+    Pick the id that orders an update: the chat (or user) it belongs to.
+    Updates with the same key always land on the same worker, so a user's
+    messages and next-step replies are handled in the order they were sent.
+    """
+    for field in ("message", "edited_message", "callback_query", "channel_post", "my_chat_member", "chat_member"):
+        obj = data.get(field)
+        if not obj:
+            continue
+        chat = obj.get("chat") or (obj.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id", 0)
+        return (obj.get("from") or {}).get("id", 0)
+    return data.get("update_id", 0)
+
+class WebhookServer:
+    """
+    Receives Telegram webhook pushes and processes them on a worker pool.
+
+    Each POST is checked against the secret token, queued and acknowledged
+    immediately; workers then run the bot's handlers. A full queue answers
+    503 so Telegram retries the update later instead of it being lost.
+
+    There is always a secret: without one anybody who can reach the port
+    could post updates as an owner. When none is configured a random one is
+    generated; pass server.secret to set_webhook().
+    """
+
+    def __init__(self, bot, listen, port, path, secret="", workers=8, queue_size=10000):
+        self.bot = bot
+        self.path = path
+        self.secret = secret or secrets.token_urlsafe(32)
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._workers = []
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.received = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.started_at = None
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._server_thread = None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = server.accept(self.path, self.headers, self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def accept(self, path, headers, body):
+        """Validate and enqueue one pushed update; returns the HTTP status."""
+        if path != self.path:
+            return 404
+        token = headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            with self._lock:
+                self.rejected += 1
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            with self._lock:
+                self.rejected += 1
+            return 400
+        shard = self._queues[hash(_update_key(data)) % len(self._queues)]
+        try:
+            shard.put_nowait((time.monotonic(), data))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return 503
+        with self._lock:
+            self.received += 1
+        return 200
+
+    def _work(self, q):
+        while True:
+            try:
+                item = q.get(timeout=0.5)
+            except queue.Empty:
+                # Queue drained after stop(), even if no sentinel fit in it.
+                if self._stopping.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            received_at, data = item
+            try:
+                self.bot.process_new_updates([types.Update.de_json(data)])
+            except Exception as e:
+                print(f"Error processing update {data.get('update_id')}: {e}")
+                with self._lock:
+                    self.failed += 1
+            with self._lock:
+                self.processed += 1
+                self._latencies.append(time.monotonic() - received_at)
+
+    def start(self):
+        self.started_at = time.monotonic()
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._work, args=(q,), name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+        self._server_thread = threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True)
+        self._server_thread.start()
+
+    def stop(self, timeout=10):
+        """Stop accepting updates, finish the queued ones and shut down."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._stopping.set()
+        for q in self._queues:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass  # the worker exits once it has drained the queue
+        for t in self._workers:
+            t.join(timeout)
+
+    def wait(self):
+        self._server_thread.join()
+
+    def metrics(self):
+        """Counters, queue depth, throughput and end-to-end latency percentiles."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            processed = self.processed
+            snapshot = {
+                "received": self.received,
+                "processed": processed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+            }
+        snapshot["queue_depth"] = sum(q.qsize() for q in self._queues)
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        snapshot["updates_per_sec"] = processed / elapsed if elapsed else 0.0
+        for name, pct in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+            snapshot[f"latency_{name}_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * pct))] * 1000 if latencies else 0.0
+        return snapshot